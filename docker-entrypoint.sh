@@ -21,6 +21,8 @@ if [ "$1" == "uwsgi" ]; then
     umask 77
     openssl req -new -newkey rsa:2048 -days 3650 -nodes -x509 -keyout ${UWSGI_KEY} -out ${UWSGI_CERT} -subj "/O=container/OU=uwsgi/CN=$HOSTNAME"
   fi
+
+  obra-migrate
 fi
 
 exec "$@"
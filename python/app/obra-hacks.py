@@ -31,4 +31,5 @@ application = create_application()
 
 if __name__ == '__main__':
     logging.basicConfig(level="DEBUG")
+    import_module('obra_hacks.backend.migrations').migrate()
     application.run(debug=True)
@@ -1,15 +1,45 @@
 import logging
 import os
 from datetime import date
+from importlib import import_module
 
-from obra_hacks.backend import data, models, rankings, scrapers, upgrades
+from obra_hacks.api import caching
+from obra_hacks.backend import (data, maintenance, models, rankings, scrapers,
+                                upgrades, versions)
 
-import uwsgi
 from uwsgidecorators import rbtimer
 
 logger = logging.getLogger(__name__)
 logger.info('{} imported'.format(__name__))
 full_scrape_done = False
+maintenance_budget = int(os.environ.get('MAINTENANCE_BUDGET', 30))
+warm_paths = os.environ.get('WARM_PATHS', ','.join(['/api/v1/upgrades/pending/',
+                                                     '/api/v1/upgrades/pending/top/',
+                                                     '/api/v1/upgrades/recent/',
+                                                     '/api/v1/upgrades/recent/top/',
+                                                     '/api/v1/ranks/',
+                                                     '/api/v1/events/recent/',
+                                                     '/api/v1/events/years/'])).split(',')
+warm_top = int(os.environ.get('WARM_TOP', 20))
+
+
+def get_application():
+    # Load the app here rather than at import, so that only the spooler pays for it
+    return import_module('obra-hacks').application
+
+
+def expire_versions():
+    tags = versions.pop_touched()
+    if tags:
+        caching.expire_versions(get_application(), tags)
+
+
+def warm_cache():
+    if 'NO_WARM' in os.environ:
+        logger.debug('Cache warming disabled by NO_WARM')
+        return
+
+    caching.warm_cache(get_application(), [p for p in warm_paths if p], warm_top)
 
 
 @rbtimer(600, target='spooler')
@@ -27,9 +57,10 @@ def scrape_events(num):
     else:
         years = range(cur_year - 6, cur_year + 1)
 
+    # Scrapers touch the data version for anything they change, and track_changes for anything
+    # recalculated, which invalidates just the affected API cache entries when this commits.
+    warm = False
     for discipline in data.DISCIPLINE_MAP.keys():
-        clear_cache = False
-
         # Do the entire discipline re-scrape in a transaction
         with models.db.atomic('IMMEDIATE'):
             for year in years:
@@ -38,16 +69,18 @@ def scrape_events(num):
                 scrapers.clean_events(year, discipline)
 
             if scrapers.scrape_new(discipline) or not full_scrape_done:
-                if upgrades.recalculate_points(discipline, incremental=full_scrape_done):
-                    rankings.calculate_race_ranks(discipline, incremental=full_scrape_done)
-                    upgrades.sum_points(discipline)
-                    upgrades.confirm_pending_upgrades(discipline)
-                    clear_cache = True
-
-        if clear_cache:
-            uwsgi.cache_clear('default')
+                with versions.track_changes(discipline):
+                    if upgrades.recalculate_points(discipline, incremental=full_scrape_done):
+                        rankings.calculate_race_ranks(discipline, incremental=full_scrape_done)
+                        upgrades.sum_points(discipline)
+                        rankings.calculate_category_ranks(discipline)
+                        upgrades.confirm_pending_upgrades(discipline)
+                        warm = True
+        expire_versions()
 
     full_scrape_done = True
+    if warm:
+        warm_cache()
 
 
 @rbtimer(1800, target='spooler')
@@ -56,17 +89,28 @@ def scrape_recent(num):
         logger.debug('Recent event re-scrape disabled by NO_SCRAPE')
         return
 
+    warm = False
     for discipline in data.DISCIPLINE_MAP.keys():
-        clear_cache = False
-
         # Do the entire discipline update in a transaction
         with models.db.atomic('IMMEDIATE'):
             if scrapers.scrape_recent(discipline, 3):
-                if upgrades.recalculate_points(discipline, incremental=True):
-                    rankings.calculate_race_ranks(discipline, incremental=True)
-                    upgrades.sum_points(discipline)
-                    upgrades.confirm_pending_upgrades(discipline)
-                    clear_cache = True
-
-        if clear_cache:
-            uwsgi.cache_clear('default')
+                with versions.track_changes(discipline):
+                    if upgrades.recalculate_points(discipline, incremental=True):
+                        rankings.calculate_race_ranks(discipline, incremental=True)
+                        upgrades.sum_points(discipline)
+                        rankings.calculate_category_ranks(discipline)
+                        upgrades.confirm_pending_upgrades(discipline)
+                        warm = True
+        expire_versions()
+
+    if warm:
+        warm_cache()
+
+
+@rbtimer(3600, target='spooler')
+def database_maintenance(num):
+    if 'NO_MAINTENANCE' in os.environ:
+        logger.debug('Database maintenance disabled by NO_MAINTENANCE')
+        return
+
+    maintenance.run_maintenance(maintenance_budget)
@@ -0,0 +1,298 @@
+import gzip
+import hashlib
+import logging
+import os
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime
+from email.utils import formatdate
+from functools import wraps
+from time import sleep, time
+
+from obra_hacks.api.serializers import dump_json
+from obra_hacks.backend.data import DISCIPLINE_MAP
+from obra_hacks.backend.versions import get_versions, tag
+
+from flask import Response, request
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Responses that cover every discipline change whenever any of them do
+DISCIPLINE_TAGS = [tag('discipline', d) for d in DISCIPLINE_MAP.keys()]
+
+# Request counts are kept per-process and merged into the shared cache every so often
+HITS_KEY = 'hits'
+HITS_FLUSH_INTERVAL = 60
+HITS_LIMIT = 1000
+HOT_PREFIXES = ['/api/v1/results/person/', '/api/v1/results/event/']
+WARM_HEADER = 'X-Cache-Warm'
+
+# How long a worker rendering a response holds the lock, and how long other workers wait on it
+LOCK_TIMEOUT = 60
+LOCK_WAIT = 10
+LOCK_POLL = 0.05
+
+# Bodies at least this big are stored precompressed alongside the uncompressed copy
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Data versions are cached so that conditional requests don't have to touch the database. The spooler expires them
+# as soon as it commits a change; the timeout covers changes made by other processes, like the command line tools.
+VERSIONS_PREFIX = 'version/'
+VERSIONS_TIMEOUT = 60
+hits = Counter()
+hits_flushed = time()
+
+
+def get_app_version():
+    """
+    Get a short hash of the application source, and the time it was last modified, so that ETags and cached responses
+    change whenever a deploy changes the code that renders them. Migrations are part of the source, so this covers
+    schema changes too.
+    """
+    digest = hashlib.sha1()
+    modified = 0
+    for dirpath, dirnames, filenames in os.walk(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                path = os.path.join(dirpath, filename)
+                modified = max(modified, os.path.getmtime(path))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return (digest.hexdigest()[:8], datetime.fromtimestamp(int(modified)))
+
+
+APP_VERSION, APP_MODIFIED = get_app_version()
+
+
+@contextmanager
+def hits_lock():
+    """Hold the uwsgi lock while updating the shared hit counts, when running under uwsgi"""
+    if uwsgi:
+        uwsgi.lock()
+    try:
+        yield
+    finally:
+        if uwsgi:
+            uwsgi.unlock()
+
+
+def record_hit(cache):
+    """
+    Count a request for the current path, so that the most popular pages can be warmed after the data changes.
+    """
+    global hits_flushed
+    if request.headers.get(WARM_HEADER):
+        return
+
+    hits[request.path] += 1
+    if time() - hits_flushed >= HITS_FLUSH_INTERVAL:
+        with hits_lock():
+            shared = Counter(cache.get(HITS_KEY) or {})
+            shared.update(hits)
+            cache.set(HITS_KEY, dict(shared.most_common(HITS_LIMIT)), timeout=0)
+        hits.clear()
+        hits_flushed = time()
+
+
+def warm_cache(app, paths, top=20):
+    """
+    Render a list of API paths plus the top N most requested pages for each of HOT_PREFIXES,
+    so that they're cached before anyone has to wait on them. Hit counts are halved afterwards
+    so that pages that were popular a long time ago eventually drop off the list.
+    """
+    cache = next(iter(app.extensions['cache']))
+    shared = Counter(cache.get(HITS_KEY) or {})
+    paths = list(paths)
+    for prefix in HOT_PREFIXES:
+        paths.extend([path for path, count in shared.most_common() if path.startswith(prefix)][:top])
+
+    client = app.test_client()
+    for path in paths:
+        start = time()
+        response = client.get(path, headers={WARM_HEADER: '1'})
+        logger.info('Warmed {} in {:.3f} seconds: {}'.format(path, time() - start, response.status_code))
+
+    with hits_lock():
+        shared = Counter(cache.get(HITS_KEY) or {})
+        cache.set(HITS_KEY, {path: count // 2 for path, count in shared.items() if count > 1}, timeout=0)
+
+
+def get_cached_versions(cache, tags):
+    """
+    Get the current (version, updated) for each tag, from the cache if possible, or the database if not.
+    """
+    cached = cache.get_many(*[VERSIONS_PREFIX + t for t in tags])
+    versions = {t: v for t, v in zip(tags, cached) if v is not None}
+    missing = [t for t in tags if t not in versions]
+    if missing:
+        fetched = get_versions(missing)
+        cache.set_many({VERSIONS_PREFIX + t: v for t, v in fetched.items()}, timeout=VERSIONS_TIMEOUT)
+        versions.update(fetched)
+    return versions
+
+
+def expire_versions(app, tags):
+    """
+    Drop cached versions for a list of tags, so that the API sees new versions straight away
+    rather than after VERSIONS_TIMEOUT. Call this after committing the transaction that touched them.
+    """
+    cache = next(iter(app.extensions['cache']))
+    tags = list(tags)
+    for i in range(0, len(tags), 500):
+        cache.delete_many(*[VERSIONS_PREFIX + t for t in tags[i:i + 500]])
+
+
+def versioned_cache(cache, timeout, *tags, **kwargs):
+    """
+    Decorator for API resource methods whose responses depend on a set of data version tags.
+    Tags may reference view arguments, ie: 'person:{id}', or be functions of them that return a tag or None.
+    Pass query_string=True to vary on the query string.
+    Responses that also depend on the current date should pass dates=<function returning the date or dates they use>.
+
+    Responses are cached under a key built from the application version, the dates, and the current version of each tag,
+    and carry a matching weak ETag and Last-Modified. Weak, since the same ETag is used for each Content-Encoding.
+    Tag versions are cached as well, so conditional requests for a current copy get a 304 without touching the database.
+
+    Response bodies are encoded to JSON and compressed before they are cached, so cache hits are served as-is
+    in the best encoding the client accepts.
+    On a cache miss, only one worker at a time renders the response. Other workers wait up to LOCK_WAIT seconds for
+    it to show up in the cache, or with stale_while_revalidate=True, get the previous version straight away if there is one.
+    """
+    query_string = kwargs.get('query_string', False)
+    stale_while_revalidate = kwargs.get('stale_while_revalidate', False)
+    dates = kwargs.get('dates')
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            record_hit(cache)
+            request_tags = [t(**request.view_args) if callable(t) else t.format(**request.view_args) for t in tags]
+            request_tags = [t for t in request_tags if t]
+            versions = get_cached_versions(cache, request_tags)
+            etag = [APP_VERSION]
+            updated = [APP_MODIFIED] + [u for v, u in versions.values() if u]
+            if dates:
+                window = dates()
+                etag.extend(d.strftime('%Y%m%d') for d in (window if isinstance(window, tuple) else (window, )))
+                # The window may have moved as of midnight
+                updated.append(datetime.combine(date.today(), datetime.min.time()))
+            etag = '.'.join(etag + [str(versions[t][0]) for t in request_tags])
+            modified = max(updated).replace(microsecond=0)
+
+            headers = {'ETag': 'W/"{}"'.format(etag),
+                       'Last-Modified': formatdate(timeval=modified.timestamp(), usegmt=True),
+                       }
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = request.if_modified_since and request.if_modified_since.timestamp() >= modified.timestamp()
+
+            if not_modified:
+                headers['Expires'] = formatdate(timeval=time() + timeout, usegmt=True)
+                return Response(status=304, headers=headers)
+
+            path = 'view/{}'.format(request.path)
+            if query_string:
+                path += '?' + '&'.join('{}={}'.format(k, v) for k, v in sorted(request.args.items(multi=True)))
+
+            rv = get_or_render(cache, timeout, path, etag, stale_while_revalidate, f, *args, **kwargs)
+            if isinstance(rv, StaleResponse):
+                # The body is from an older version, so it has to carry that version's ETag
+                headers = {'ETag': 'W/"{}"'.format(rv.etag)}
+                rv = rv.rv
+
+            bodies, code, rv_headers = rv
+            if code in (200, 404):
+                headers.update(rv_headers)
+            else:
+                headers = dict(rv_headers)
+
+            encoding = request.accept_encodings.best_match([e for e in ('br', 'gzip') if e in bodies] + ['identity'], default='identity')
+            if encoding != 'identity':
+                headers['Content-Encoding'] = encoding
+            headers['Vary'] = 'Accept-Encoding'
+            return Response(bodies[encoding], status=code, headers=headers, mimetype='application/json')
+
+        return decorated
+    return decorator
+
+
+class StaleResponse(object):
+    """A cached response from an older data version, returned while the current version is being rendered"""
+    def __init__(self, etag, rv):
+        self.etag = etag
+        self.rv = rv
+
+
+def get_or_render(cache, timeout, path, etag, stale_while_revalidate, f, *args, **kwargs):
+    """
+    Get the response for a path at a data version from the cache, or render and cache it.
+    A sentinel key ensures only one process renders a given response at a time.
+    """
+    key = '{}#{}'.format(path, etag)
+    latest_key = '{}#latest'.format(path)
+    lock_key = '{}#lock'.format(key)
+
+    rv = cache.get(key)
+    if rv is not None:
+        return rv
+
+    deadline = time() + LOCK_WAIT
+    while not cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+        if stale_while_revalidate:
+            latest = cache.get(latest_key)
+            stale = cache.get('{}#{}'.format(path, latest)) if latest else None
+            if stale is not None:
+                return StaleResponse(latest, stale)
+        if time() >= deadline:
+            logger.warning('Timed out waiting for {} to be rendered'.format(key))
+            return render(f, *args, **kwargs)
+        sleep(LOCK_POLL)
+        rv = cache.get(key)
+        if rv is not None:
+            return rv
+
+    try:
+        rv = render(f, *args, **kwargs)
+        cache.set(key, rv, timeout=timeout)
+        cache.set(latest_key, etag, timeout=timeout)
+    finally:
+        cache.delete(lock_key)
+    return rv
+
+
+def render(f, *args, **kwargs):
+    """
+    Call a resource method and encode the response body, so that it only has to be done once per data version.
+    Returns ({encoding: body}, code, headers).
+    """
+    rv = f(*args, **kwargs)
+    data, code, headers = rv if len(rv) == 3 else rv + ({},)
+    return (compress(dump_json(data).encode('utf-8')), code, headers)
+
+
+def compress(body):
+    """
+    Compress a response body with each available encoding, keyed by Content-Encoding.
+    Small bodies aren't worth compressing, and are only stored as-is.
+    """
+    bodies = {'identity': body}
+    if len(body) >= COMPRESS_MIN_SIZE:
+        bodies['gzip'] = gzip.compress(body, GZIP_LEVEL)
+        if brotli:
+            bodies['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return bodies
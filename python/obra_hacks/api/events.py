@@ -1,9 +1,11 @@
 import logging
+from collections import defaultdict
 from email.utils import formatdate
 from time import time
 
+from obra_hacks.api.caching import DISCIPLINE_TAGS, versioned_cache
 from obra_hacks.backend.data import DISCIPLINE_MAP
-from obra_hacks.backend.models import Event, Race, Series
+from obra_hacks.backend.models import Event, Series
 from peewee import JOIN, fn
 
 from flask_restx import Resource, fields, marshal
@@ -28,7 +30,7 @@ def register(api, cache):
     event = ns.model('YearEvent',
                      {'id': fields.Integer,
                       'name': fields.String,
-                      'date': fields.Date,
+                      'date': fields.Date(attribute='last_race_date'),
                       'series': fields.Nested(series, allow_null=True),
                       })
 
@@ -52,14 +54,13 @@ def register(api, cache):
         """
         Get recent events from any year and discipline, sorted by date
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS)
         def get(self):
-            query = (Event.select(Event, Series, fn.MAX(Race.date).alias('date'))
+            query = (Event.select(Event, Series)
                           .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
-                          .join(Race, src=Event)
                           .where(Event.ignore == False)
-                          .order_by(Race.date.desc(), Event.name.asc())
-                          .group_by(Event)
+                          .where(Event.last_race_date.is_null(False))
+                          .order_by(Event.last_race_date.desc(), Event.name.asc())
                           .limit(6))
             return ([marshal(e, event_with_discipline) for e in query], 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -70,7 +71,7 @@ def register(api, cache):
         """
         Get a list of years that we have data for
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS)
         def get(self):
             query = (Event.select(fn.DISTINCT(Event.year))
                           .order_by(Event.year.desc())
@@ -85,21 +86,24 @@ def register(api, cache):
         """
         Get a list of events for this year, grouped by discipline
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, 'year:{year}')
         def get(self, year):
+            query = (Event.select(Event, Series)
+                          .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
+                          .where(Event.year == year)
+                          .where(Event.ignore == False)
+                          .where(Event.last_race_date.is_null(False))
+                          .order_by(Event.last_race_date.desc(), Series.name.asc(), Event.name.asc()))
+
+            events = defaultdict(list)
+            for event in query:
+                events[event.upgrade_discipline].append(event)
+
             disciplines = []
             for upgrade_discipline in DISCIPLINE_MAP.keys():
-                query = (Event.select(Event, Series, fn.MAX(Race.date).alias('date'))
-                              .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
-                              .join(Race, src=Event)
-                              .where(Event.ignore == False)
-                              .where(Event.year == year)
-                              .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                              .group_by(Event)
-                              .order_by(fn.MAX(Race.date).desc(), Series.name.asc(), Event.name.asc()))
                 data = {'name': upgrade_discipline,
                         'display': upgrade_discipline.split('_')[0].title(),
-                        'events': query,
+                        'events': events[upgrade_discipline],
                         }
                 disciplines.append(data)
             return ([marshal(d, discipline_with_events) for d in disciplines], 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
@@ -1,14 +1,128 @@
 import logging
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
 from email.utils import formatdate
+from heapq import nsmallest
+from threading import Lock, Thread
 from time import time
 
-from obra_hacks.backend.models import Person
+from obra_hacks.api.caching import versioned_cache
+from obra_hacks.api.serializers import compile_model
+from obra_hacks.backend.models import Person, PersonIndex, Race, Result, db
+from obra_hacks.backend.rankings import get_recent_date
+from obra_hacks.backend.versions import get_versions, tag
+from peewee import JOIN, Case, fn
 
 from flask import request
 from flask_restx import Resource, fields, marshal
 
 logger = logging.getLogger(__name__)
 cache_timeout = 900
+search_limit = 20
+search_max_limit = 100
+search_candidates = 200
+suggest_limit = 10
+suggest_max_limit = 50
+suggest_refresh_interval = 30
+
+NAME_STRIP_RE = re.compile(r'[^\w\s]+')
+Suggestion = namedtuple('Suggestion', 'id,name,first_name,last_name,team_name,recent_races')
+
+
+def normalize_name(name):
+    """
+    Normalize a name for prefix matching, so that case, accents, punctuation, and extra spaces are ignored
+    """
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(NAME_STRIP_RE.sub('', name).split())
+
+
+class NameIndex(object):
+    """
+    An in-process index of normalized names for prefix search, so that typeahead queries don't need to touch the database.
+    Each Person is indexed under both their full name and their last name. Names are kept in a sorted list alongside an array
+    of positions in the list of people, so a prefix query is just a pair of binary searches.
+    The index is rebuilt when the people data version changes, which is checked at most every suggest_refresh_interval seconds.
+    Rebuilds run in a background thread; searches are answered from the previous index until the new one is swapped in.
+    """
+    def __init__(self):
+        self.version = None
+        self.recent_date = None
+        self.checked = 0
+        self.data = ([], array('I'), [])
+        self.lock = Lock()
+
+    def refresh(self, background=True):
+        now = time()
+        if now - self.checked < suggest_refresh_interval:
+            return
+        self.checked = now
+
+        version = get_versions([tag('people')])[tag('people')][0]
+        recent_date = get_recent_date()
+        if version == self.version and recent_date == self.recent_date:
+            return
+
+        # Only one rebuild at a time; if one is already running, the next check will pick up anything it missed
+        if not self.lock.acquire(blocking=False):
+            return
+        if background:
+            Thread(target=self.rebuild, args=(version, recent_date), name='name-index', daemon=True).start()
+        else:
+            self.rebuild(version, recent_date)
+
+    def rebuild(self, version, recent_date):
+        try:
+            with db.connection_context():
+                self.build(recent_date)
+            self.version = version
+            self.recent_date = recent_date
+        except Exception:
+            logger.exception('Unable to rebuild name index')
+        finally:
+            self.lock.release()
+
+    def build(self, recent_date):
+        start = time()
+        recent_races = dict(Result.select(Result.person_id, fn.COUNT(Result.id))
+                                  .join(Race, src=Result)
+                                  .where(Race.date >= recent_date)
+                                  .group_by(Result.person_id)
+                                  .tuples())
+
+        people = []
+        names = []
+        query = Person.select(Person.id, Person.first_name, Person.last_name, Person.team_name).tuples()
+        for person_id, first_name, last_name, team_name in query:
+            position = len(people)
+            name = first_name + ' ' + last_name
+            people.append(Suggestion(person_id, name, first_name, last_name, team_name, recent_races.get(person_id, 0)))
+            for key in {normalize_name(name), normalize_name(last_name)}:
+                if key:
+                    names.append((key, position))
+
+        names.sort()
+        # Swap everything in at once, so that a search in another thread never sees a mix of old and new
+        self.data = ([key for key, position in names], array('I', (position for key, position in names)), people)
+        logger.info('Built name index with {} names for {} people in {:.3f} seconds'.format(len(names), len(people), time() - start))
+
+    def search(self, prefix, limit):
+        """
+        Get up to limit people with a name starting with prefix, most active first
+        """
+        keys, positions, people = self.data
+        prefix = normalize_name(prefix)
+        start = bisect_left(keys, prefix)
+        end = bisect_right(keys, prefix + '\U0010ffff', start)
+        matches = {positions[i] for i in range(start, end)}
+        return [people[p] for p in nsmallest(limit, matches, key=lambda p: (-people[p].recent_races, people[p].name))]
+
+
+name_index = NameIndex()
 
 
 def register(api, cache):
@@ -22,28 +136,101 @@ def register(api, cache):
                        'team_name': fields.String,
                        })
 
+    suggestion = ns.clone('Suggestion', result,
+                          {'recent_races': fields.Integer,
+                           })
+
+    serialize_suggestions = compile_model(suggestion)
+
+    # Build the name index up front rather than on the first request. Close the connection afterwards,
+    # so that it isn't inherited by workers forked after the app is loaded.
+    try:
+        with db.connection_context():
+            name_index.refresh(background=False)
+    except Exception:
+        logger.warning('Unable to build name index; it will be built on first use', exc_info=True)
+
     @ns.route('/')
     @ns.response(200, 'Success', [result])
     @ns.response(400, 'Bad Request')
     @ns.response(500, 'Server Error')
     class PeopleSearch(Resource):
         """
-        Get a list of people whose name matches a search string
+        Get a list of people whose name or team matches a search string.
+        People whose name starts with the search string come first, followed by matches anywhere in their name,
+        and then matches on their team. Within each group, people who have raced more recently are listed first.
         """
         @ns.param(name='name', description='Name Search String', type='string', minLength=3, required=True)
-        @cache.cached(timeout=cache_timeout, query_string=True)
+        @ns.param(name='limit', description='Maximum Results', type='integer', minimum=1, maximum=search_max_limit, default=search_limit)
+        @versioned_cache(cache, cache_timeout, 'people', query_string=True, dates=get_recent_date)
         def get(self):
             name = request.args.get('name', '')
             if len(name) < 3:
                 return ({'message': 'Search string too short'}, 400)
 
-            query = (Person.select(Person,
-                                   Person.first_name
-                                         .concat(' ')
-                                         .concat(Person.last_name)
-                                         .alias('name'))
-                           .where(Person.first_name
-                           .concat(' ')
-                           .concat(Person.last_name)
-                           .contains(name)))
+            try:
+                limit = int(request.args.get('limit', search_limit))
+            except ValueError:
+                return ({'message': 'Invalid limit'}, 400)
+
+            if limit < 1 or limit > search_max_limit:
+                return ({'message': 'Invalid limit'}, 400)
+
+            full_name = Person.first_name.concat(' ').concat(Person.last_name)
+            match_quality = Case(None, [(full_name.startswith(name), 0),
+                                        (Person.last_name.startswith(name), 1),
+                                        (full_name.contains(name), 2),
+                                        ], 3)
+
+            # Search for the whole string as a single phrase; the trigram tokenizer matches it anywhere in a column.
+            # Only the best search_candidates matches are ordered by recent activity, so that short, common
+            # search strings don't count up races for thousands of people.
+            candidates = (Person.select(Person.id, match_quality.alias('match_quality'), PersonIndex.rank().alias('rank'))
+                                .join(PersonIndex, src=Person, on=(PersonIndex.rowid == Person.id))
+                                .where(PersonIndex.match('"{}"'.format(name.replace('"', '""'))))
+                                .order_by(match_quality, PersonIndex.rank())
+                                .limit(search_candidates)
+                                .cte('candidates'))
+            recent_races = (Result.select(Result.person_id, fn.COUNT(Result.id).alias('count'))
+                                  .join(Race, src=Result)
+                                  .where(Result.person_id << candidates.select(candidates.c.id))
+                                  .where(Race.date >= get_recent_date())
+                                  .group_by(Result.person_id)
+                                  .alias('recent_races'))
+
+            query = (Person.select(Person, full_name.alias('name'))
+                           .join(candidates, src=Person, on=(candidates.c.id == Person.id))
+                           .join(recent_races, JOIN.LEFT_OUTER, src=Person, on=(recent_races.c.person_id == Person.id))
+                           .order_by(candidates.c.match_quality, fn.COALESCE(recent_races.c.count, 0).desc(), candidates.c.rank,
+                                     Person.last_name, Person.first_name)
+                           .with_cte(candidates)
+                           .limit(limit))
             return ([marshal(r, result) for r in query], 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
+
+    @ns.route('/suggest/')
+    @ns.response(200, 'Success', [suggestion])
+    @ns.response(400, 'Bad Request')
+    @ns.response(500, 'Server Error')
+    class PeopleSuggest(Resource):
+        """
+        Get the most active people whose first, full, or last name starts with a prefix, for typeahead.
+        This is answered from an index held in memory by each worker, and does not query the database.
+        """
+        @ns.param(name='name', description='Name Prefix', type='string', minLength=1, required=True)
+        @ns.param(name='limit', description='Maximum Results', type='integer', minimum=1, maximum=suggest_max_limit, default=suggest_limit)
+        def get(self):
+            name = request.args.get('name', '')
+            if not normalize_name(name):
+                return ({'message': 'Search string too short'}, 400)
+
+            try:
+                limit = int(request.args.get('limit', suggest_limit))
+            except ValueError:
+                return ({'message': 'Invalid limit'}, 400)
+
+            if limit < 1 or limit > suggest_max_limit:
+                return ({'message': 'Invalid limit'}, 400)
+
+            name_index.refresh()
+            return (serialize_suggestions(name_index.search(name, limit)), 200,
+                    {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
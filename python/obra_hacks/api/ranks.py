@@ -5,11 +5,13 @@ import logging
 from email.utils import formatdate
 from time import time
 
+from obra_hacks.api.caching import DISCIPLINE_TAGS, versioned_cache
 from obra_hacks.backend.data import DISCIPLINE_MAP
-from obra_hacks.backend.models import Person
-from obra_hacks.backend.rankings import get_ranks
+from obra_hacks.backend.models import CategoryRank, Person
+from obra_hacks.backend.rankings import get_rank_dates, get_ranks
 from peewee import Entity, Select, fn
 
+from flask import request
 from flask_restx import Resource, fields, marshal
 
 try:
@@ -48,13 +50,36 @@ def register(api, cache):
     @ns.response(500, 'Server Error')
     class DisciplineRanks(Resource):
         """
-        Get the top 500 ranks, grouped by discipline
+        Get the top 500 ranks, grouped by discipline, optionally limited to people currently in a single category
         """
-        @cache.cached(timeout=cache_timeout)
+        @ns.param(name='category', description='Current Category', type='integer', required=False)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, query_string=True, stale_while_revalidate=True, dates=get_rank_dates)
         def get(self):
+            category = request.args.get('category')
+            if category is not None:
+                try:
+                    category = int(category)
+                except ValueError:
+                    return ({'message': 'Invalid category'}, 400)
+
             disciplines = []
 
             for upgrade_discipline in DISCIPLINE_MAP.keys():
+                if category is not None:
+                    # Category leaderboards are precomputed by the ranking stage
+                    query = (Person.select(Person, CategoryRank.value.alias('rank'), CategoryRank.place)
+                                   .join(CategoryRank, src=Person)
+                                   .where(CategoryRank.discipline == upgrade_discipline)
+                                   .where(CategoryRank.category == category)
+                                   .order_by(CategoryRank.place.asc(), CategoryRank.value.asc())
+                                   .limit(501)
+                                   .objects())
+                    disciplines.append({'name': upgrade_discipline,
+                                        'display': upgrade_discipline.split('_')[0].title(),
+                                        'ranks': query,
+                                        })
+                    continue
+
                 ranks = get_ranks(upgrade_discipline)
                 ranked_people_ids = sorted([k for k in ranks.keys() if k], key=lambda k: ranks[k])[:501]
                 ranked_people_json = Select(from_list=[fn.JSON_EACH(json.dumps(ranked_people_ids))], columns=[Entity('value')])
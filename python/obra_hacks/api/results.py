@@ -1,21 +1,41 @@
 import logging
-from copy import deepcopy
+from collections import defaultdict, namedtuple
 from email.utils import formatdate
 from time import time
 
+from obra_hacks.api.caching import versioned_cache
+from obra_hacks.api.serializers import compile_model
 from obra_hacks.backend.data import DISCIPLINE_MAP
 from obra_hacks.backend.models import (Event, ObraPersonSnapshot,
                                             PendingUpgrade, Person, Points,
                                             Quality, Race, Rank, Result,
                                             Series)
-from obra_hacks.backend.rankings import get_ranks
+from obra_hacks.backend.rankings import get_discipline_ranks, get_rank_dates
+from obra_hacks.backend.versions import tag
 from peewee import JOIN
 
-from flask_restx import Resource, fields, marshal
+from flask_restx import Resource, fields
 
 logger = logging.getLogger(__name__)
 cache_timeout = 900
 
+# Stands in for Points on results that didn't earn any, carrying forward the running totals
+PointsFiller = namedtuple('PointsFiller', 'value,sum_value,sum_categories,notes,needs_upgrade')
+event_disciplines = {}
+
+
+def get_event_discipline_tag(id):
+    """
+    Get the data version tag for an Event's upgrade discipline, or None if there's no such Event.
+    Events don't move between disciplines, so each worker only needs to look this up once.
+    """
+    if id not in event_disciplines:
+        upgrade_discipline = Event.select(Event.upgrade_discipline).where(Event.id == id).scalar()
+        if upgrade_discipline is None:
+            return None
+        event_disciplines[id] = tag('discipline', upgrade_discipline)
+    return event_disciplines[id]
+
 
 def register(api, cache):
     ns = api.namespace('results', 'Race Results')
@@ -24,6 +44,9 @@ def register(api, cache):
         if isinstance(r.pending, list) and r.pending:
             return r.pending[0].upgrade_confirmation.date
 
+    def filler_points(points):
+        return PointsFiller(0, points.sum_value, points.sum_categories, '', points.needs_upgrade)
+
     def fill_results(pdr):
         if not pdr['results']:
             return []
@@ -31,20 +54,14 @@ def register(api, cache):
         # Create initial filler point. The oldest result SHOULD have placeholder points,
         # but if for some reason it does not we create our own based on the race info.
         if pdr['results'][-1].points:
-            last_points = deepcopy(pdr['results'][-1].points[0])
-            last_points.result = None
-            last_points.notes = ''
-            last_points.value = 0
+            last_points = filler_points(pdr['results'][-1].points[0])
         else:
-            last_points = Points(sum_categories=pdr['results'][-1].race.categories)
+            last_points = PointsFiller(0, 0, pdr['results'][-1].race.categories, '', False)
 
         # Backfill points from oldest to newest
         for result in reversed(pdr['results']):
             if result.points:
-                last_points = deepcopy(result.points[0])
-                last_points.result = None
-                last_points.notes = ''
-                last_points.value = 0
+                last_points = filler_points(result.points[0])
             else:
                 result.points.append(last_points)
 
@@ -132,6 +149,10 @@ def register(api, cache):
                              {'races': fields.List(fields.Nested(event_race_results)),
                               })
 
+    # Compile the models once, instead of having marshal walk them for every result
+    serialize_person_results = compile_model(person_results)
+    serialize_event_results = compile_model(event_results)
+
     @ns.route('/person/<int:id>')
     @ns.response(200, 'Success', person_results)
     @ns.response(404, 'Not Found')
@@ -140,32 +161,43 @@ def register(api, cache):
         """
         Return results for a person.
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, 'person:{id}', stale_while_revalidate=True, dates=get_rank_dates)
         def get(self, id):
             try:
                 db_person = Person.get_by_id(id)
-                db_person.disciplines = []
-                for upgrade_discipline in DISCIPLINE_MAP.keys():
-                    ranks = get_ranks(upgrade_discipline, None, [id])
-                    query = (Result.select(Result, Points, PendingUpgrade, ObraPersonSnapshot, Race, Event, Series, Rank, Quality)
-                                   .join(Points, src=Result, join_type=JOIN.LEFT_OUTER)
-                                   .join(PendingUpgrade, src=Result, join_type=JOIN.LEFT_OUTER)
-                                   .join(ObraPersonSnapshot, src=PendingUpgrade, join_type=JOIN.LEFT_OUTER)
-                                   .join(Race, src=Result)
-                                   .join(Event, src=Race)
-                                   .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
-                                   .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
-                                   .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
-                                   .where(Result.person == db_person)
-                                   .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                                   .order_by(Race.date.desc(), Race.created.desc()))
-
-                    db_person.disciplines.append({'name': upgrade_discipline,
-                                                  'display': upgrade_discipline.split('_')[0].title(),
-                                                  'rank': ranks[id],
-                                                  'results': query.prefetch(Points, PendingUpgrade, ObraPersonSnapshot, Race, Event, Series, Rank, Quality),
-                                                  })
-                return (marshal(db_person, person_results), 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
+                ranks = get_discipline_ranks([id])
+                query = (Result.select(Result, Race, Event, Series, Points, Rank, Quality, PendingUpgrade, ObraPersonSnapshot)
+                               .join(Race, src=Result)
+                               .join(Event, src=Race)
+                               .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
+                               .join(Points, src=Result, join_type=JOIN.LEFT_OUTER, attr='joined_points')
+                               .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER, attr='joined_rank')
+                               .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER, attr='joined_quality')
+                               .join(PendingUpgrade, src=Result, join_type=JOIN.LEFT_OUTER, attr='joined_pending')
+                               .join(ObraPersonSnapshot, src=PendingUpgrade, join_type=JOIN.LEFT_OUTER)
+                               .where(Result.person == db_person)
+                               .order_by(Race.date.desc(), Race.created.desc()))
+
+                # Get everything in one pass, then group by discipline. The models expect the
+                # one-to-one relations as lists, the way prefetch would have populated them.
+                results = defaultdict(list)
+                seen = set()
+                for result in query:
+                    if result.id in seen:
+                        continue
+                    seen.add(result.id)
+                    result.points = [result.joined_points] if result.joined_points is not None else []
+                    result.rank = [result.joined_rank] if result.joined_rank is not None else []
+                    result.pending = [result.joined_pending] if result.joined_pending is not None else []
+                    result.race.quality = [result.race.joined_quality] if result.race.joined_quality is not None else []
+                    results[result.race.event.upgrade_discipline].append(result)
+
+                db_person.disciplines = [{'name': upgrade_discipline,
+                                          'display': upgrade_discipline.split('_')[0].title(),
+                                          'rank': ranks[upgrade_discipline][id],
+                                          'results': results[upgrade_discipline],
+                                          } for upgrade_discipline in DISCIPLINE_MAP.keys()]
+                return (serialize_person_results(db_person), 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
             except Person.DoesNotExist:
                 return ({}, 404, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -177,7 +209,7 @@ def register(api, cache):
         """
         Return results for an event.
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, 'event:{id}', get_event_discipline_tag, stale_while_revalidate=True)
         def get(self, id):
             try:
                 event = Event.get_by_id(id)
@@ -185,7 +217,7 @@ def register(api, cache):
                                     .order_by(Race.name.asc())
                                     .prefetch(Result, Points, Person, Rank, Quality))
                 if event.races:
-                    return (marshal(event, event_results), 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
+                    return (serialize_event_results(event), 200, {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
                 else:
                     raise Event.DoesNotExist()
             except Event.DoesNotExist:
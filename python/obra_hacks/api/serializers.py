@@ -0,0 +1,151 @@
+import logging
+from datetime import datetime
+
+from flask import current_app
+from flask_restx import fields
+
+try:
+    from ujson import dumps
+except ImportError:
+    from json import dumps
+
+logger = logging.getLogger(__name__)
+
+
+def dump_json(data):
+    """
+    Encode response data exactly the way flask_restx's default JSON representation does
+    """
+    settings = dict(current_app.config.get('RESTX_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    return dumps(data, **settings) + '\n'
+
+
+def compile_model(model):
+    """
+    Compile a flask_restx model into a function that produces the same output as marshal(obj, model).
+    All the per-field lookups and type checks are done once up front, instead of on every call.
+    Integer attributes index into rows, so plain tuples from .tuples() queries can be serialized as well.
+    The model itself is left alone, so it still documents the response in Swagger.
+    """
+    model_fields = [(key, compile_field(key, field)) for key, field in getattr(model, 'resolved', model).items()]
+
+    def serialize(obj):
+        if isinstance(obj, list):
+            return [serialize(o) for o in obj]
+        return {key: output(obj) for key, output in model_fields}
+
+    return serialize
+
+
+def identity(value):
+    return value
+
+
+def compile_getter(key):
+    """Build a function that pulls a value off an object the same way flask_restx.fields.get_value does"""
+    if callable(key):
+        return key
+
+    if isinstance(key, int):
+        def get_index(obj):
+            try:
+                return obj[key]
+            except (IndexError, KeyError, TypeError):
+                return None
+        return get_index
+
+    if '.' in key:
+        getters = [compile_getter(k) for k in key.split('.')]
+
+        def get_path(obj):
+            for getter in getters:
+                obj = getter(obj)
+            return obj
+        return get_path
+
+    def get_key(obj):
+        if isinstance(obj, dict):
+            return obj.get(key)
+        return getattr(obj, key, None)
+    return get_key
+
+
+def compile_format(field):
+    """Get the fastest equivalent of field.format for a scalar field"""
+    if type(field) is fields.Integer:
+        return int
+    if type(field) is fields.String:
+        return str
+    if type(field) is fields.Date:
+        def format_date(value):
+            if isinstance(value, datetime):
+                return value.date().isoformat()
+            if isinstance(value, str):
+                return field.format(value)
+            return value.isoformat()
+        return format_date
+    return field.format
+
+
+def compile_field(key, field):
+    """Compile a single field into a function that gets and formats its value from an object"""
+    field = fields.Raw() if field is None else field
+    field = field() if isinstance(field, type) else field
+    if field.mask:
+        raise ValueError('Field masks are not supported: {}'.format(key))
+
+    get = compile_getter(key if field.attribute is None else field.attribute)
+
+    if isinstance(field, fields.Nested):
+        return compile_nested(get, field)
+
+    if isinstance(field, fields.List):
+        container = field.container
+        if container.attribute is not None:
+            raise ValueError('List container attributes are not supported: {}'.format(key))
+        if isinstance(container, fields.Nested):
+            item = compile_nested(identity, container)
+        else:
+            item = compile_scalar(identity, container)
+
+        def output_list(obj):
+            value = get(obj)
+            if value is None:
+                return field._v('default')
+            if isinstance(value, dict):
+                return field.output(key, obj)
+            return [item(v) for v in value]
+        return output_list
+
+    return compile_scalar(get, field)
+
+
+def compile_nested(get, field):
+    serialize = compile_model(field.nested)
+    allow_null = field.allow_null
+    default = field.default
+
+    def output_nested(obj):
+        value = get(obj)
+        if value is None:
+            if allow_null:
+                return None
+            elif default is not None:
+                return default
+        return serialize(value)
+    return output_nested
+
+
+def compile_scalar(get, field):
+    format = compile_format(field)
+    default = field._v('default')
+    default_value = format(default) if default else default
+
+    def output_scalar(obj):
+        value = get(obj)
+        if value is None:
+            return default_value
+        return format(value)
+    return output_scalar
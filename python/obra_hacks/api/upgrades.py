@@ -1,19 +1,25 @@
 import logging
-from datetime import date
 from email.utils import formatdate
 from time import time
 
+from obra_hacks.api.caching import DISCIPLINE_TAGS, versioned_cache
+from obra_hacks.api.serializers import compile_model
 from obra_hacks.backend.data import DISCIPLINE_MAP
-from obra_hacks.backend.models import (Event, ObraPersonSnapshot,
-                                            PendingUpgrade, Person, Points,
-                                            Quality, Race, Rank, Result,
-                                            Series)
-from peewee import JOIN, Entity, Select, Window, fn
+from obra_hacks.backend.models import (Event, LatestResult,
+                                            ObraPersonSnapshot, PendingUpgrade,
+                                            Person, Points, PointsLeaderboard,
+                                            Quality, Race, Rank, Result, Series,
+                                            UpgradeEvent)
+from obra_hacks.backend.rankings import get_recent_date
+from peewee import JOIN, Window, fn
 
-from flask_restx import Resource, fields, marshal
+from flask import request
+from flask_restx import Resource, fields
 
 logger = logging.getLogger(__name__)
 cache_timeout = 900
+leaderboard_limit = 50
+leaderboard_max_limit = 500
 
 
 def register(api, cache):
@@ -103,6 +109,30 @@ def register(api, cache):
                                    'results': fields.List(fields.Nested(result_with_person_and_race)),
                                    })
 
+    # Current points standing for a person
+    leaderboard_entry = ns.model('LeaderboardEntry',
+                                 {'category': fields.Integer,
+                                  'sum_value': fields.Integer,
+                                  'needs_upgrade': fields.Boolean,
+                                  'date': fields.Date,
+                                  'person': fields.Nested(person),
+                                  })
+
+    # Page of points standings for a single discipline and category
+    leaderboard = ns.model('PointsLeaderboard',
+                           {'name': fields.String,
+                            'display': fields.String,
+                            'category': fields.Integer,
+                            'page': fields.Integer,
+                            'limit': fields.Integer,
+                            'results': fields.List(fields.Nested(leaderboard_entry)),
+                            })
+
+    # Compile the models once, instead of having marshal walk them for every result
+    serialize_discipline_results = compile_model(discipline_results)
+    serialize_result_with_person_and_race_with_event = compile_model(result_with_person_and_race_with_event)
+    serialize_leaderboard = compile_model(leaderboard)
+
     @ns.route('/pending/')
     @ns.response(200, 'Success', [discipline_results])
     @ns.response(500, 'Server Error')
@@ -111,36 +141,13 @@ def register(api, cache):
         Get the most recent result for each person, if that person needed an upgrade as of that event,
         grouped by discipline, sorted by category and points
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, stale_while_revalidate=True, dates=get_recent_date)
         def get(self):
             # limit results to people who raced since jan 1 of the previous year
-            start_year = date.today().year - 1
-            if start_year == 2020:
-                start_year = 2019  # f*ck 2020
-            start_date = date(start_year, 1, 1)
+            start_date = get_recent_date()
             disciplines = []
 
             for upgrade_discipline in DISCIPLINE_MAP.keys():
-                # Subquery to find the most recent result for each person
-                latest_cte = (Result.select()
-                                    .join(Race, src=Result)
-                                    .join(Event, src=Race)
-                                    .join(Person, src=Result)
-                                    .where(Race.date >= start_date)
-                                    .where(Race.categories.length() > 0)
-                                    .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                                    .select(fn.DISTINCT(fn.FIRST_VALUE(Result.id)
-                                                          .over(partition_by=[Result.person_id],
-                                                                order_by=[Race.date.desc(), Race.created.desc()],
-                                                                start=Window.preceding()
-                                                                )
-                                                        ).alias('result_id'))
-                                    .cte('latest_results'))
-
-                latest_results = Select(
-                    from_list=[fn.JSON_EACH(latest_cte.select_from(fn.JSON_GROUP_ARRAY(latest_cte.c.result_id).python_value(str)).scalar())],
-                    columns=[Entity('value')])
-
                 query = (Result.select(Result,
                                        Race,
                                        Event,
@@ -150,6 +157,7 @@ def register(api, cache):
                                        ObraPersonSnapshot,
                                        Rank,
                                        Quality)
+                               .join(LatestResult, src=Result, on=(LatestResult.result == Result.id))
                                .join(Race, src=Result)
                                .join(Event, src=Race)
                                .join(Person, src=Result)
@@ -158,10 +166,12 @@ def register(api, cache):
                                .join(ObraPersonSnapshot, src=PendingUpgrade, join_type=JOIN.LEFT_OUTER)
                                .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
                                .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
-                               .where(Result.id << latest_results)
-                               .where(Points.needs_upgrade == True)
-                               .order_by(Points.sum_categories.asc(),
-                                         Points.sum_value.desc()))
+                               .where(LatestResult.discipline == upgrade_discipline)
+                               .where(LatestResult.date >= start_date)
+                               .where(LatestResult.needs_upgrade == True)
+                               .order_by(LatestResult.sum_category_min.asc(),
+                                         LatestResult.sum_category_mask.desc(),
+                                         LatestResult.sum_value.desc()))
 
                 disciplines.append({'name': upgrade_discipline,
                                     'display': upgrade_discipline.split('_')[0].title(),
@@ -169,7 +179,7 @@ def register(api, cache):
                                                               Points, PendingUpgrade, ObraPersonSnapshot, Rank, Quality),
                                     })
 
-            return ([marshal(d, discipline_results) for d in disciplines],
+            return ([serialize_discipline_results(d) for d in disciplines],
                     200,
                     {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -180,32 +190,22 @@ def register(api, cache):
         """
         Get the most recent 6 pending upgrade results, sorted by category and points
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, stale_while_revalidate=True, dates=get_recent_date)
         def get(self):
             # limit results to people who raced since jan 1 of the previous year
-            start_year = date.today().year - 1
-            if start_year == 2020:
-                start_year = 2019  # f*ck 2020
-            start_date = date(start_year, 1, 1)
-
-            # Subquery to find the most recent result for each person
-            latest_cte = (Result.select()
-                                .join(Race, src=Result)
-                                .join(Event, src=Race)
-                                .join(Person, src=Result)
-                                .where(Race.date >= start_date)
-                                .where(Race.categories.length() > 0)
-                                .select(fn.DISTINCT(fn.FIRST_VALUE(Result.id)
-                                                      .over(partition_by=[Result.person_id],
-                                                            order_by=[Race.date.desc(), Race.created.desc()],
-                                                            start=Window.preceding()
-                                                            )
-                                                    ).alias('result_id'))
-                                .cte('latest_results'))
-
-            latest_results = Select(
-                from_list=[fn.JSON_EACH(latest_cte.select_from(fn.JSON_GROUP_ARRAY(latest_cte.c.result_id).python_value(str)).scalar())],
-                columns=[Entity('value')])
+            start_date = get_recent_date()
+
+            # Subquery to find the most recent result for each person, across all disciplines
+            latest_results = (LatestResult.select()
+                                          .join(Result, src=LatestResult)
+                                          .join(Race, src=Result)
+                                          .where(LatestResult.date >= start_date)
+                                          .select(fn.DISTINCT(fn.FIRST_VALUE(LatestResult.result)
+                                                                .over(partition_by=[LatestResult.person],
+                                                                      order_by=[LatestResult.date.desc(), Race.created.desc()],
+                                                                      start=Window.preceding()
+                                                                      )
+                                                              ).alias('result_id')))
 
             query = (Result.select(Result,
                                    Race,
@@ -224,11 +224,12 @@ def register(api, cache):
                            .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
                            .where(Result.id << latest_results)
                            .where(Points.needs_upgrade == True)
-                           .order_by(Points.sum_categories.asc(),
+                           .order_by(Points.sum_category_min.asc(),
+                                     Points.sum_category_mask.desc(),
                                      Points.sum_value.desc())
                            .limit(6))
 
-            return ([marshal(r, result_with_person_and_race_with_event) for r in query.prefetch(Race, Event, Series, Person, Points, Rank, Quality)],
+            return ([serialize_result_with_person_and_race_with_event(r) for r in query.prefetch(Race, Event, Series, Person, Points, Rank, Quality)],
                     200,
                     {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -239,13 +240,10 @@ def register(api, cache):
         """
         Get all results where the person upgraded or downgraded, grouped by discipline, sorted by date, category, name
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, stale_while_revalidate=True, dates=get_recent_date)
         def get(self):
             # limit results to people who raced since jan 1 of the previous year
-            start_year = date.today().year - 1
-            if start_year == 2020:
-                start_year = 2019  # f*ck 2020
-            start_date = date(start_year, 1, 1)
+            start_date = get_recent_date()
             disciplines = []
 
             for upgrade_discipline in DISCIPLINE_MAP.keys():
@@ -259,6 +257,7 @@ def register(api, cache):
                                        ObraPersonSnapshot,
                                        Rank,
                                        Quality)
+                               .join(UpgradeEvent, src=Result)
                                .join(Race, src=Result)
                                .join(Event, src=Race)
                                .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
@@ -268,12 +267,12 @@ def register(api, cache):
                                .join(ObraPersonSnapshot, src=PendingUpgrade, join_type=JOIN.LEFT_OUTER)
                                .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
                                .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
-                               .where(Race.date >= start_date)
+                               .where(UpgradeEvent.discipline == upgrade_discipline)
+                               .where(UpgradeEvent.date >= start_date)
                                .where(~(Race.name.contains('junior')))
-                               .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                               .where(Points.notes.contains('upgraded') | Points.notes.contains('downgraded'))
                                .order_by(Race.date.desc(),
-                                         Points.sum_categories.asc(),
+                                         Points.sum_category_min.asc(),
+                                         Points.sum_category_mask.desc(),
                                          Person.last_name.asc(),
                                          Person.first_name.asc()))
 
@@ -283,7 +282,7 @@ def register(api, cache):
                                                               Points, PendingUpgrade, ObraPersonSnapshot, Rank, Quality),
                                     })
 
-            return ([marshal(d, discipline_results) for d in disciplines],
+            return ([serialize_discipline_results(d) for d in disciplines],
                     200,
                     {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -294,13 +293,10 @@ def register(api, cache):
         """
         Get the most recent 6 results where the person upgraded or downgraded, sorted by date, category, name
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, stale_while_revalidate=True, dates=get_recent_date)
         def get(self):
             # limit results to people who raced since jan 1 of the previous year
-            start_year = date.today().year - 1
-            if start_year == 2020:
-                start_year = 2019  # f*ck 2020
-            start_date = date(start_year, 1, 1)
+            start_date = get_recent_date()
 
             query = (Result.select(Result,
                                    Race,
@@ -310,6 +306,7 @@ def register(api, cache):
                                    Points,
                                    Rank,
                                    Quality)
+                           .join(UpgradeEvent, src=Result)
                            .join(Race, src=Result)
                            .join(Event, src=Race)
                            .join(Series, src=Event, join_type=JOIN.LEFT_OUTER)
@@ -317,16 +314,16 @@ def register(api, cache):
                            .join(Points, src=Result)
                            .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
                            .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
-                           .where(Race.date >= start_date)
+                           .where(UpgradeEvent.date >= start_date)
                            .where(~(Race.name.contains('Junior')))
-                           .where(Points.notes.contains('upgraded') | Points.notes.contains('downgraded'))
                            .order_by(Race.date.desc(),
-                                     Points.sum_categories.asc(),
+                                     Points.sum_category_min.asc(),
+                                     Points.sum_category_mask.desc(),
                                      Person.last_name.asc(),
                                      Person.first_name.asc())
                            .limit(6))
 
-            return ([marshal(r, result_with_person_and_race_with_event) for r in query.prefetch(Race, Event, Series, Person, Points, Rank, Quality)],
+            return ([serialize_result_with_person_and_race_with_event(r) for r in query.prefetch(Race, Event, Series, Person, Points, Rank, Quality)],
                     200,
                     {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
 
@@ -338,36 +335,13 @@ def register(api, cache):
         Get the most recent result for each person, if that person had upgrade points as of that event,
         grouped by discipline, sorted by points and category
         """
-        @cache.cached(timeout=cache_timeout)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, stale_while_revalidate=True, dates=get_recent_date)
         def get(self):
             # limit results to people who raced since jan 1 of the previous year
-            start_year = date.today().year - 1
-            if start_year == 2020:
-                start_year = 2019  # f*ck 2020
-            start_date = date(start_year, 1, 1)
+            start_date = get_recent_date()
             disciplines = []
 
             for upgrade_discipline in DISCIPLINE_MAP.keys():
-                # Subquery to find the most recent result for each person
-                latest_cte = (Result.select()
-                                    .join(Race, src=Result)
-                                    .join(Event, src=Race)
-                                    .join(Person, src=Result)
-                                    .where(Race.date >= start_date)
-                                    .where(Race.categories.length() > 0)
-                                    .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                                    .select(fn.DISTINCT(fn.FIRST_VALUE(Result.id)
-                                                          .over(partition_by=[Result.person_id],
-                                                                order_by=[Race.date.desc(), Race.created.desc()],
-                                                                start=Window.preceding()
-                                                                )
-                                                        ).alias('result_id'))
-                                    .cte('latest_results'))
-
-                latest_results = Select(
-                    from_list=[fn.JSON_EACH(latest_cte.select_from(fn.JSON_GROUP_ARRAY(latest_cte.c.result_id).python_value(str)).scalar())],
-                    columns=[Entity('value')])
-
                 query = (Result.select(Result,
                                        Race,
                                        Event,
@@ -377,6 +351,7 @@ def register(api, cache):
                                        ObraPersonSnapshot,
                                        Rank,
                                        Quality)
+                               .join(LatestResult, src=Result, on=(LatestResult.result == Result.id))
                                .join(Race, src=Result)
                                .join(Event, src=Race)
                                .join(Person, src=Result)
@@ -385,10 +360,12 @@ def register(api, cache):
                                .join(ObraPersonSnapshot, src=PendingUpgrade, join_type=JOIN.LEFT_OUTER)
                                .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
                                .join(Quality, src=Race, join_type=JOIN.LEFT_OUTER)
-                               .where(Result.id << latest_results)
-                               .where(Points.value > 0)
-                               .order_by(Points.sum_value.desc(),
-                                         Points.sum_categories.asc()))
+                               .where(LatestResult.discipline == upgrade_discipline)
+                               .where(LatestResult.date >= start_date)
+                               .where(LatestResult.value > 0)
+                               .order_by(LatestResult.sum_value.desc(),
+                                         LatestResult.sum_category_min.asc(),
+                                         LatestResult.sum_category_mask.desc()))
 
                 disciplines.append({'name': upgrade_discipline,
                                     'display': upgrade_discipline.split('_')[0].title(),
@@ -396,6 +373,58 @@ def register(api, cache):
                                                               Points, PendingUpgrade, ObraPersonSnapshot, Rank, Quality),
                                     })
 
-            return ([marshal(d, discipline_results) for d in disciplines],
+            return ([serialize_discipline_results(d) for d in disciplines],
+                    200,
+                    {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
+
+    @ns.route('/leaderboard/')
+    @ns.response(200, 'Success', leaderboard)
+    @ns.response(400, 'Bad Request')
+    @ns.response(500, 'Server Error')
+    class UpgradesLeaderboard(Resource):
+        """
+        Get current upgrade points for everyone in a discipline and category who raced recently, sorted by points
+        """
+        @ns.param(name='discipline', description='Upgrade Discipline', type='string', enum=list(DISCIPLINE_MAP.keys()), required=True)
+        @ns.param(name='category', description='Current Category', type='integer', required=True)
+        @ns.param(name='page', description='Page Number', type='integer', minimum=1, default=1)
+        @ns.param(name='limit', description='Results per Page', type='integer', minimum=1, maximum=leaderboard_max_limit, default=leaderboard_limit)
+        @versioned_cache(cache, cache_timeout, *DISCIPLINE_TAGS, query_string=True, stale_while_revalidate=True, dates=get_recent_date)
+        def get(self):
+            upgrade_discipline = request.args.get('discipline', '')
+            if upgrade_discipline not in DISCIPLINE_MAP:
+                return ({'message': 'Invalid discipline'}, 400)
+
+            try:
+                category = int(request.args['category'])
+                page = int(request.args.get('page', 1))
+                limit = int(request.args.get('limit', leaderboard_limit))
+            except (KeyError, ValueError):
+                return ({'message': 'Invalid category, page, or limit'}, 400)
+
+            if page < 1 or limit < 1 or limit > leaderboard_max_limit:
+                return ({'message': 'Invalid page or limit'}, 400)
+
+            # limit results to people who raced since jan 1 of the previous year
+            start_date = get_recent_date()
+
+            query = (PointsLeaderboard.select(PointsLeaderboard, Person)
+                                      .join(Person, src=PointsLeaderboard)
+                                      .where(PointsLeaderboard.discipline == upgrade_discipline)
+                                      .where(PointsLeaderboard.category == category)
+                                      .where(PointsLeaderboard.date >= start_date)
+                                      .order_by(PointsLeaderboard.sum_value.desc(),
+                                                PointsLeaderboard.person.asc())
+                                      .paginate(page, limit))
+
+            data = {'name': upgrade_discipline,
+                    'display': upgrade_discipline.split('_')[0].title(),
+                    'category': category,
+                    'page': page,
+                    'limit': limit,
+                    'results': query,
+                    }
+
+            return (serialize_leaderboard(data),
                     200,
                     {'Expires': formatdate(timeval=time() + cache_timeout, usegmt=True)})
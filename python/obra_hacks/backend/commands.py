@@ -4,51 +4,137 @@ from __future__ import unicode_literals
 
 import logging
 from datetime import date
+from itertools import zip_longest
+from multiprocessing import Pool
 
 import click
 
 from .data import DISCIPLINE_MAP
-from .outputs import OUTPUT_MAP
+from .outputs import OUTPUT_MAP, STDOUT
 
 
 @click.command()
-@click.option('--discipline', type=click.Choice(DISCIPLINE_MAP.keys()), required=True)
-@click.option('--output', type=click.Choice(sorted(OUTPUT_MAP.keys())), default='text')
+@click.option('--discipline', 'disciplines', type=click.Choice(DISCIPLINE_MAP.keys()), multiple=True, required=True)
+@click.option('--output', 'output_formats', type=click.Choice(sorted(OUTPUT_MAP.keys())), multiple=True, default=['text'])
+@click.option('--path', 'paths', multiple=True,
+              help='Path for each --output, in the same order. May contain {discipline}. Defaults to stdout.')
 @click.option('--scrape/--no-scrape', default=True)
+@click.option('--parallel/--no-parallel', default=False, help='Write output for each discipline in a separate process.')
 @click.option('--debug/--no-debug', default=False)
-def cli(discipline, output, scrape, debug):
+def cli(disciplines, output_formats, paths, scrape, parallel, debug):
     log_level = 'DEBUG' if debug else 'INFO'
     logging.basicConfig(level=log_level, format='%(levelname)s:%(module)s.%(funcName)s:%(message)s')
 
+    disciplines = [d for d in DISCIPLINE_MAP.keys() if d in disciplines]
+    if len(paths) > len(output_formats):
+        raise click.BadParameter('Got more paths than outputs', param_hint='--path')
+    outputs = list(zip_longest(output_formats, paths, fillvalue=STDOUT))
+
+    for output_format, path in outputs:
+        if output_format == 'people' and path == STDOUT:
+            raise click.BadParameter('People output must be written to a directory', param_hint='--path')
+
+    if len([output_format for output_format, path in outputs if path == STDOUT and output_format != 'null']) > 1:
+        raise click.BadParameter('Only one output can be written to stdout', param_hint='--path')
+
+    if len(disciplines) > 1:
+        for output_format, path in outputs:
+            if output_format == 'null':
+                continue
+            if path == STDOUT and parallel:
+                raise click.BadParameter('Cannot write multiple disciplines to stdout in parallel', param_hint='--path')
+            if path != STDOUT and '{discipline}' not in path:
+                raise click.BadParameter('Path for multiple disciplines must contain {discipline}', param_hint='--path')
+
     # Import these after setting up logging otherwise we don't get logs
     from .scrapers import clean_events, scrape_year, scrape_new, scrape_parents, scrape_recent
     from .upgrades import confirm_pending_upgrades, recalculate_points, print_points, sum_points
-    from .rankings import calculate_race_ranks
+    from .rankings import calculate_category_ranks, calculate_race_ranks
+    from .versions import track_changes
     from .models import db
+    from . import migrations
+
+    # Make sure the schema is current before touching anything
+    migrations.migrate()
 
-    with db.atomic('IMMEDIATE'):
-        if scrape:
-            # Scrape last 5 years of results
-            cur_year = date.today().year
-            for year in range(cur_year - 6, cur_year + 1):
-                scrape_year(year, discipline)
-                scrape_parents(year, discipline)
-                clean_events(year, discipline)
+    for discipline in disciplines:
+        with db.atomic('IMMEDIATE'):
+            if scrape:
+                # Scrape last 5 years of results
+                cur_year = date.today().year
+                for year in range(cur_year - 6, cur_year + 1):
+                    scrape_year(year, discipline)
+                    scrape_parents(year, discipline)
+                    clean_events(year, discipline)
 
-            # Load in anything new
-            scrape_new(discipline)
+                # Load in anything new
+                scrape_new(discipline)
 
-            # Check for updates to anything touched in the last three days
-            scrape_recent(discipline, 3)
+                # Check for updates to anything touched in the last three days
+                scrape_recent(discipline, 3)
 
-        # Calculate points from new data
-        if recalculate_points(discipline, incremental=False):
-            calculate_race_ranks(discipline, incremental=False)
-            sum_points(discipline)
-            confirm_pending_upgrades(discipline)
+            # Calculate points from new data
+            with track_changes(discipline):
+                if recalculate_points(discipline, incremental=False):
+                    calculate_race_ranks(discipline, incremental=False)
+                    sum_points(discipline)
+                    calculate_category_ranks(discipline)
+                    confirm_pending_upgrades(discipline)
 
     # Finally, output data
-    print_points(discipline, output)
+    if parallel and len(disciplines) > 1:
+        # Each process needs its own connection; don't let them inherit ours
+        db.close()
+        with Pool(len(disciplines)) as pool:
+            pool.starmap(print_points, [(discipline, outputs) for discipline in disciplines])
+    else:
+        for discipline in disciplines:
+            print_points(discipline, outputs)
+
+
+@click.command()
+@click.option('--status/--no-status', default=False, help='List applied and pending migrations without applying them.')
+@click.option('--check/--no-check', default=False,
+              help='Check that a database with the baseline schema migrates to the same schema as a new one, without touching the real database.')
+@click.option('--debug/--no-debug', default=False)
+def migrate(status, check, debug):
+    """Apply pending database schema migrations"""
+    log_level = 'DEBUG' if debug else 'INFO'
+    logging.basicConfig(level=log_level, format='%(levelname)s:%(module)s.%(funcName)s:%(message)s')
+
+    from . import migrations
+    from .models import SchemaVersion
+
+    if check:
+        problems = migrations.check()
+        for problem in problems:
+            click.echo(problem, err=True)
+        if problems:
+            raise click.ClickException('Migrations do not produce the current schema')
+        click.echo('Migrations produce the current schema')
+    elif status:
+        applied = SchemaVersion.select().order_by(SchemaVersion.version.asc()) if SchemaVersion.table_exists() else []
+        for version in applied:
+            click.echo('{:>4} {:<40} applied {}'.format(version.version, version.name, version.applied))
+        for version, step in migrations.get_pending():
+            click.echo('{:>4} {:<40} pending'.format(version, step.__name__))
+    else:
+        migrations.migrate()
+
+
+@click.command()
+@click.option('--debug/--no-debug', default=False)
+def vacuum(debug):
+    """
+    Rebuild the database with a full VACUUM, converting it to incremental vacuum if needed.
+    Locks the database until it's done, so stop anything else using it first.
+    """
+    log_level = 'DEBUG' if debug else 'INFO'
+    logging.basicConfig(level=log_level, format='%(levelname)s:%(module)s.%(funcName)s:%(message)s')
+
+    from . import maintenance
+
+    maintenance.run_full_vacuum()
 
 
 if __name__ == '__main__':
@@ -162,3 +162,8 @@ DISCIPLINE_MAP = OrderedDict([
     ('mountain_bike', ['mountain_bike', 'downhill', 'super_d', 'short_track']),
     ('track',         ['track']),
 ])
+
+# Map event disciplines back to their upgrade discipline
+UPGRADE_DISCIPLINE_MAP = {discipline: upgrade_discipline
+                          for upgrade_discipline, disciplines in DISCIPLINE_MAP.items()
+                          for discipline in disciplines}
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+from datetime import datetime, timedelta
+from time import time
+
+from .models import MaintenanceLog, db
+
+logger = logging.getLogger(__name__)
+analyze_interval = timedelta(days=1)
+vacuum_pages = 256
+
+
+def last_run(step):
+    """Get the last time a maintenance step was run, or None if it never has been"""
+    log = MaintenanceLog.get_or_none(MaintenanceLog.step == step)
+    return log.last_run if log else None
+
+
+def run_step(step, func, *args):
+    """Run a maintenance step and record when it ran and how long it took"""
+    start = time()
+    detail = func(*args) or ''
+    duration = time() - start
+    logger.info('Maintenance step {} took {:.3f} seconds: {}'.format(step, duration, detail))
+    (MaintenanceLog.insert(step=step, last_run=datetime.now(), duration=round(duration, 3), detail=detail)
+                   .on_conflict_replace()
+                   .execute())
+
+
+def optimize():
+    db.execute_sql('PRAGMA optimize').fetchall()
+
+
+def analyze():
+    db.execute_sql('ANALYZE')
+
+
+def checkpoint():
+    busy, log_frames, checkpointed = db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return '{} of {} frames checkpointed{}'.format(checkpointed, log_frames, ' (busy)' if busy else '')
+
+
+def vacuum(deadline):
+    """
+    Release free pages back to the filesystem a chunk at a time until there are none left, or we're out of time.
+    Databases created without incremental vacuum enabled need a single full VACUUM to convert them; that takes as long
+    as it takes, so it's left to obra-vacuum rather than done here.
+    """
+    if db.pragma('auto_vacuum') != 2:
+        logger.warning('Database does not have incremental vacuum enabled; run obra-vacuum to convert it')
+        return 'skipped, incremental vacuum not enabled'
+
+    freed = 0
+    free_pages = db.pragma('freelist_count')
+    while free_pages and time() < deadline:
+        db.execute_sql('PRAGMA incremental_vacuum({})'.format(vacuum_pages)).fetchall()
+        remaining = db.pragma('freelist_count')
+        freed += free_pages - remaining
+        free_pages = remaining
+    return '{} pages freed, {} remaining'.format(freed, free_pages)
+
+
+def full_vacuum():
+    db.execute_sql('VACUUM')
+    return 'auto_vacuum is {}'.format(db.pragma('auto_vacuum'))
+
+
+def run_full_vacuum():
+    """
+    Rebuild the whole database with a full VACUUM, which also converts it to incremental vacuum if it isn't already.
+    The database is locked until it finishes, so this is only ever run on purpose, never on a schedule.
+    """
+    with db.connection_context():
+        run_step('full_vacuum', full_vacuum)
+
+
+def run_maintenance(budget=30):
+    """
+    Run database maintenance. Cheap steps run every time; ANALYZE runs at most once per analyze_interval,
+    and whatever remains of the time budget (in seconds) is spent on incremental vacuum.
+    """
+    deadline = time() + budget
+
+    with db.connection_context():
+        run_step('optimize', optimize)
+
+        last_analyze = last_run('analyze')
+        if not last_analyze or datetime.now() - last_analyze >= analyze_interval:
+            run_step('analyze', analyze)
+
+        run_step('checkpoint', checkpoint)
+
+        if time() < deadline:
+            run_step('vacuum', vacuum, deadline)
+        else:
+            logger.info('Skipping vacuum; maintenance time budget of {} seconds exhausted'.format(budget))
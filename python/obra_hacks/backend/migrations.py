@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+from peewee import Case, fn
+
+from .data import UPGRADE_DISCIPLINE_MAP
+from .models import MODELS, Event, SchemaVersion, db
+
+logger = logging.getLogger(__name__)
+MIGRATIONS = []
+
+# The schema and some sample rows from before migrations existed, for checking that they upgrade cleanly
+BASELINE_SCHEMA = [
+    'CREATE TABLE "series" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "year" INTEGER NOT NULL, "dates" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "event" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "discipline" VARCHAR(255) NOT NULL, '
+    '"year" INTEGER NOT NULL, "date" VARCHAR(255) NOT NULL, "series_id" INTEGER, "parent_id" INTEGER, "ignore" INTEGER NOT NULL, '
+    'FOREIGN KEY ("series_id") REFERENCES "series" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT, '
+    'FOREIGN KEY ("parent_id") REFERENCES "event" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "person" ("id" INTEGER NOT NULL PRIMARY KEY, "first_name" VARCHAR(255) NOT NULL, "last_name" VARCHAR(255) NOT NULL, '
+    '"team_name" VARCHAR(255) NOT NULL)',
+    'CREATE TABLE "obrapersonsnapshot" ("id" INTEGER NOT NULL PRIMARY KEY, "date" DATE NOT NULL, "person_id" INTEGER NOT NULL, '
+    '"license" INTEGER, "mtb_category" INTEGER NOT NULL, "dh_category" INTEGER NOT NULL, "ccx_category" INTEGER NOT NULL, '
+    '"road_category" INTEGER NOT NULL, "track_category" INTEGER NOT NULL, '
+    'FOREIGN KEY ("person_id") REFERENCES "person" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "race" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "date" DATE NOT NULL, "categories" TEXT NOT NULL, '
+    '"starters" INTEGER NOT NULL, "created" DATETIME NOT NULL, "updated" DATETIME NOT NULL, "event_id" INTEGER NOT NULL, '
+    'FOREIGN KEY ("event_id") REFERENCES "event" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "result" ("id" INTEGER NOT NULL PRIMARY KEY, "race_id" INTEGER NOT NULL, "person_id" INTEGER, "place" VARCHAR(255) NOT NULL, '
+    '"time" INTEGER, "laps" INTEGER, FOREIGN KEY ("race_id") REFERENCES "race" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT, '
+    'FOREIGN KEY ("person_id") REFERENCES "person" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "pendingupgrade" ("result_id" INTEGER NOT NULL PRIMARY KEY, "upgrade_confirmation_id" INTEGER NOT NULL, '
+    '"discipline" VARCHAR(255) NOT NULL, FOREIGN KEY ("result_id") REFERENCES "result" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT, '
+    'FOREIGN KEY ("upgrade_confirmation_id") REFERENCES "obrapersonsnapshot" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "points" ("result_id" INTEGER NOT NULL PRIMARY KEY, "value" VARCHAR(255) NOT NULL, "notes" VARCHAR(255) NOT NULL, '
+    '"needs_upgrade" INTEGER NOT NULL, "upgrade_confirmation_id" INTEGER, "sum_value" INTEGER NOT NULL, "sum_categories" TEXT NOT NULL, '
+    'FOREIGN KEY ("result_id") REFERENCES "result" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT, '
+    'FOREIGN KEY ("upgrade_confirmation_id") REFERENCES "obrapersonsnapshot" ("id"))',
+    'CREATE TABLE "quality" ("id" INTEGER NOT NULL PRIMARY KEY, "race_id" INTEGER NOT NULL, "value" DECIMAL(10, 2) NOT NULL, '
+    '"points_per_place" DECIMAL(10, 2) NOT NULL, FOREIGN KEY ("race_id") REFERENCES "race" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE TABLE "rank" ("result_id" INTEGER NOT NULL PRIMARY KEY, "value" DECIMAL(10, 2) NOT NULL, '
+    'FOREIGN KEY ("result_id") REFERENCES "result" ("id") ON DELETE RESTRICT ON UPDATE RESTRICT)',
+    'CREATE INDEX "event_discipline" ON "event" ("discipline")',
+    'CREATE INDEX "event_series_id" ON "event" ("series_id")',
+    'CREATE INDEX "event_parent_id" ON "event" ("parent_id")',
+    'CREATE INDEX "obrapersonsnapshot_person_id" ON "obrapersonsnapshot" ("person_id")',
+    'CREATE UNIQUE INDEX "obrapersonsnapshot_date_person_id" ON "obrapersonsnapshot" ("date", "person_id")',
+    'CREATE INDEX "race_name" ON "race" ("name")',
+    'CREATE INDEX "race_event_id" ON "race" ("event_id")',
+    'CREATE INDEX "result_race_id" ON "result" ("race_id")',
+    'CREATE INDEX "result_person_id" ON "result" ("person_id")',
+    'CREATE INDEX "result_place" ON "result" ("place")',
+    'CREATE INDEX "pendingupgrade_upgrade_confirmation_id" ON "pendingupgrade" ("upgrade_confirmation_id")',
+    'CREATE INDEX "pendingupgrade_discipline" ON "pendingupgrade" ("discipline")',
+    'CREATE INDEX "points_upgrade_confirmation_id" ON "points" ("upgrade_confirmation_id")',
+    'CREATE INDEX "quality_race_id" ON "quality" ("race_id")',
+    "INSERT INTO series VALUES (1, 'Series', 2019, '1/1-2/1')",
+    "INSERT INTO event VALUES (1, 'Event', 'road', 2019, '1/1', 1, NULL, 0), (2, 'Another Event', 'cyclocross', 2019, '2/1', NULL, NULL, 0)",
+    "INSERT INTO person VALUES (1, 'First', 'Last', 'Team'), (2, 'Other', 'Person', '')",
+    "INSERT INTO obrapersonsnapshot VALUES (1, '2019-02-01', 1, 123, 3, 3, 4, 4, 5)",
+    "INSERT INTO race VALUES (1, 'Cat 4/5', '2019-01-01', '[4, 5]', 2, '2019-01-01 00:00:00', '2019-01-01 00:00:00', 1), "
+    "(2, 'Cat 3', '2019-02-01', '[3]', 1, '2019-02-01 00:00:00', '2019-02-01 00:00:00', 2)",
+    "INSERT INTO result VALUES (1, 1, 1, '1', NULL, NULL), (2, 1, 2, 'DNF', NULL, NULL), (3, 2, 1, '2', NULL, NULL)",
+    "INSERT INTO points VALUES (1, '3', '', 0, NULL, 3, '[4]'), (3, '0', '', 1, 1, 3, '[3]')",
+    "INSERT INTO pendingupgrade VALUES (3, 1, 'cyclocross')",
+    "INSERT INTO quality VALUES (1, 1, 10.0, 1.5)",
+    "INSERT INTO rank VALUES (1, 500.0)",
+]
+
+
+def migration(func):
+    """
+    Register a migration step. Steps are applied in the order they're defined; never reorder or remove them.
+    """
+    MIGRATIONS.append(func)
+    return func
+
+
+def add_missing_columns(table, *columns):
+    """
+    Add columns to a table that was created before they existed. Columns are given as (name, definition) as of the
+    migration that adds them, so that later changes to the models don't change what an old migration does.
+    NOT NULL columns must have a DEFAULT, which SQLite fills in on existing rows.
+    Returns True if any columns were added.
+    """
+    existing = {c.name for c in db.get_columns(table)}
+    missing = [(name, definition) for name, definition in columns if name not in existing]
+    if missing:
+        logger.info('Adding columns {} to {}'.format([name for name, definition in missing], table))
+        for name, definition in missing:
+            db.execute_sql('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(table, name, definition))
+    return bool(missing)
+
+
+def create_index(table, *columns):
+    """
+    Create an index if it doesn't already exist, named the same way peewee names the indexes declared on a model
+    """
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format('_'.join((table, ) + columns), table,
+                                                                        ', '.join('"{}"'.format(c) for c in columns)))
+
+
+@migration
+def create_tables():
+    """Create any missing tables"""
+    # This is the only step that may use the current models. Everything after it has to spell out its own DDL,
+    # since the models may declare columns and indexes that later steps haven't added yet.
+    db.create_tables([m for m in MODELS if not m.table_exists()])
+
+
+@migration
+def add_category_masks():
+    """Add category bitmask columns alongside the JSON categories"""
+    if add_missing_columns('race', ('category_mask', 'INTEGER NOT NULL DEFAULT 0'), ('category_min', 'INTEGER')):
+        db.execute_sql('UPDATE race SET '
+                       'category_mask = COALESCE((SELECT SUM(DISTINCT 1 << value) FROM json_each(race.categories)), 0), '
+                       'category_min = (SELECT MIN(value) FROM json_each(race.categories))')
+    if add_missing_columns('points', ('sum_category_mask', 'INTEGER NOT NULL DEFAULT 0'), ('sum_category_min', 'INTEGER')):
+        db.execute_sql('UPDATE points SET '
+                       'sum_category_mask = COALESCE((SELECT SUM(DISTINCT 1 << value) FROM json_each(points.sum_categories)), 0), '
+                       'sum_category_min = (SELECT MIN(value) FROM json_each(points.sum_categories))')
+    add_missing_columns('latestresult', ('sum_category_mask', 'INTEGER'), ('sum_category_min', 'INTEGER'))
+    create_index('race', 'category_mask')
+    create_index('points', 'sum_category_min', 'sum_category_mask')
+
+
+@migration
+def add_event_upgrade_discipline():
+    """Add the upgrade discipline to events"""
+    if add_missing_columns('event', ('upgrade_discipline', 'VARCHAR(255)')):
+        (Event.update({Event.upgrade_discipline: Case(Event.discipline, list(UPGRADE_DISCIPLINE_MAP.items()))})
+              .execute())
+    create_index('event', 'upgrade_discipline', 'year')
+    create_index('race', 'event_id', 'date')
+
+
+@migration
+def add_result_place_status():
+    """Add numeric place and finish status to results"""
+    if add_missing_columns('result', ('place_num', 'INTEGER'), ('status', "VARCHAR(255) NOT NULL DEFAULT 'finished'")):
+        db.execute_sql('UPDATE result SET '
+                       'place_num = NULLIF(CAST(place AS INTEGER), 0), '
+                       "status = CASE WHEN place LIKE '%dns%' THEN 'dns' WHEN place LIKE '%dnf%' THEN 'dnf' "
+                       "WHEN place LIKE '%dq%' THEN 'dq' ELSE 'finished' END")
+    create_index('result', 'race_id', 'place_num')
+    create_index('result', 'race_id', 'status')
+
+
+@migration
+def add_covering_indexes():
+    """Add indexes for the joins used by sum_points, get_ranks, and the API"""
+    create_index('race', 'date')
+    create_index('result', 'race_id', 'person_id')
+    create_index('result', 'person_id', 'race_id')
+    create_index('points', 'needs_upgrade')
+
+
+@migration
+def add_maintenance_log():
+    """Add a table to track database maintenance"""
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "maintenancelog" ("step" VARCHAR(255) NOT NULL PRIMARY KEY, '
+                   '"last_run" DATETIME NOT NULL, "duration" DECIMAL(10, 3) NOT NULL, "detail" VARCHAR(255) NOT NULL)')
+
+
+@migration
+def add_data_version():
+    """Add a table to track changes to cached API data"""
+    db.execute_sql('CREATE TABLE IF NOT EXISTS "dataversion" ("tag" VARCHAR(255) NOT NULL PRIMARY KEY, '
+                   '"version" INTEGER NOT NULL, "updated" DATETIME NOT NULL)')
+
+
+@migration
+def add_event_summary():
+    """Add the Race count and last Race date to events"""
+    if add_missing_columns('event', ('race_count', 'INTEGER NOT NULL DEFAULT 0'), ('last_race_date', 'DATE')):
+        db.execute_sql('UPDATE event SET '
+                       'race_count = (SELECT COUNT(*) FROM race WHERE race.event_id = event.id), '
+                       'last_race_date = (SELECT MAX(date) FROM race WHERE race.event_id = event.id)')
+    create_index('event', 'year', 'ignore', 'last_race_date')
+    create_index('event', 'ignore', 'last_race_date')
+
+
+@migration
+def add_person_index():
+    """Add a full-text index for searching people"""
+    db.execute_sql('CREATE VIRTUAL TABLE IF NOT EXISTS "personindex" USING fts5 ("name", "team_name", tokenize="trigram")')
+    db.execute_sql('DELETE FROM personindex')
+    db.execute_sql("INSERT INTO personindex (rowid, name, team_name) SELECT id, first_name || ' ' || last_name, team_name FROM person")
+
+
+def get_version():
+    """Get the most recent migration applied to the database"""
+    if not SchemaVersion.table_exists():
+        return 0
+    return SchemaVersion.select(fn.COALESCE(fn.MAX(SchemaVersion.version), 0)).scalar()
+
+
+def get_pending():
+    """Get (version, step) for each migration that hasn't been applied yet"""
+    current = get_version()
+    return [(version, step) for version, step in enumerate(MIGRATIONS, 1) if version > current]
+
+
+def migrate():
+    """
+    Apply all pending migrations in order, each in its own transaction.
+    Statistics are refreshed after each one so that the planner picks up any new indexes.
+    Returns the number of migrations applied.
+    """
+    with db.connection_context():
+        # The version table is needed to tell what's been applied, so it has to exist up front
+        db.create_tables([SchemaVersion])
+        pending = get_pending()
+        for version, step in pending:
+            logger.info('Applying migration {}: {} - {}'.format(version, step.__name__, step.__doc__))
+            with db.atomic('IMMEDIATE'):
+                step()
+                SchemaVersion.create(version=version, name=step.__name__, applied=datetime.now())
+            db.execute_sql('ANALYZE')
+
+        logger.info('Database schema is at version {}'.format(get_version()))
+        return len(pending)
+
+
+def get_schema():
+    """
+    Describe the columns of each table and the columns of each index in the database, for comparing schemas.
+    Column order is ignored, since columns added by a migration always go at the end of the table.
+    """
+    schema = {}
+    for table, in db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall():
+        columns = db.execute_sql('PRAGMA table_info("{}")'.format(table)).fetchall()
+        schema['table ' + table] = sorted(tuple(c[1:]) for c in columns)
+        for index in db.execute_sql('PRAGMA index_list("{}")'.format(table)).fetchall():
+            seq, name, unique, origin, partial = index[:5]
+            columns = db.execute_sql('PRAGMA index_xinfo("{}")'.format(name)).fetchall()
+            schema['index ' + name] = (table, unique, partial, [(c[2], c[3]) for c in columns if c[5]])
+    return schema
+
+
+def check():
+    """
+    Check that the migrations upgrade a database with the baseline schema to the same schema as a new database,
+    using scratch databases in a temporary directory. Returns a list of problems, which is empty if there are none.
+    """
+    database = db.database
+    schemas = {}
+    problems = []
+    try:
+        with TemporaryDirectory() as tmpdir:
+            for name, statements in (('baseline', BASELINE_SCHEMA), ('new', [])):
+                db.init(os.path.join(tmpdir, name + '.sqlite3'))
+                with db.connection_context():
+                    for sql in statements:
+                        db.execute_sql(sql)
+                migrate()
+                with db.connection_context():
+                    integrity = db.execute_sql('PRAGMA integrity_check').fetchall()
+                    if integrity != [('ok', )]:
+                        problems.append('{} database failed integrity check: {}'.format(name, integrity))
+                    schemas[name] = get_schema()
+    finally:
+        db.init(database)
+
+    for key in sorted(set(schemas['baseline']).union(schemas['new'])):
+        baseline, new = schemas['baseline'].get(key), schemas['new'].get(key)
+        if baseline != new:
+            problems.append('{} differs: migrated {} new {}'.format(key, baseline, new))
+    return problems
@@ -3,19 +3,20 @@
 from __future__ import unicode_literals
 
 import logging
+import re
 from os.path import expanduser
 
 import apsw
-from peewee import AutoField, BooleanField, Model
+from peewee import SQL, AutoField, BooleanField, CompositeKey, Model
 from playhouse.apsw_ext import (APSWDatabase, CharField, DateField,
                                 DateTimeField, DecimalField, ForeignKeyField,
                                 IntegerField)
-from playhouse.sqlite_ext import JSONField
+from playhouse.sqlite_ext import FTS5Model, JSONField, SearchField
 
 apsw.initialize()
 db = APSWDatabase(expanduser('~/.obra.sqlite3'),
                   pragmas=(('foreign_keys', 'on'),
-                           ('auto_vacuum', 'NONE'),
+                           ('auto_vacuum', 'INCREMENTAL'),
                            ('journal_mode', 'WAL'),
                            ('locking_mode', 'NORMAL'),
                            ('synchronous', 'NORMAL')))
@@ -23,6 +24,36 @@ db = APSWDatabase(expanduser('~/.obra.sqlite3'),
 logger = logging.getLogger(__name__)
 logger.info('Using local database {} at {}'.format(db, db.database))
 
+PLACE_RE = re.compile(r'\s*([+-]?[0-9]+)')
+RESULT_STATUS = ('finished', 'dnf', 'dns', 'dq')
+
+
+def category_mask(categories):
+    """
+    Pack a list of categories into an integer bitmask, so that category filters can use an index
+    """
+    return sum(1 << category for category in set(categories or []))
+
+
+def place_number(place):
+    """
+    Get the numeric place from a Result place, or None for DNF/DNS/DQ and the like
+    """
+    match = PLACE_RE.match(place or '')
+    if match:
+        return int(match.group(1)) or None
+
+
+def place_status(place):
+    """
+    Get the finish status for a Result place
+    """
+    place = (place or '').lower()
+    for status in ('dns', 'dnf', 'dq'):
+        if status in place:
+            return status
+    return 'finished'
+
 
 class ObraModel(Model):
     class Meta:
@@ -48,6 +79,7 @@ class Event(ObraModel):
     id = IntegerField(verbose_name='Event ID', primary_key=True)
     name = CharField(verbose_name='Event Name')
     discipline = CharField(verbose_name='Event Discipline', index=True)
+    upgrade_discipline = CharField(verbose_name='Upgrade Discipline', null=True)
     year = IntegerField(verbose_name='Event Year')
     date = CharField(verbose_name='Event Month/Day')
     series = ForeignKeyField(verbose_name='Event Series',
@@ -55,6 +87,15 @@ class Event(ObraModel):
     parent = ForeignKeyField(verbose_name='Child Events',
                              model='self', backref='children', on_update='RESTRICT', on_delete='RESTRICT', null=True)
     ignore = BooleanField(verbose_name='Ignore/Hide Event', default=False)
+    race_count = IntegerField(verbose_name='Number of Races', default=0, constraints=[SQL('DEFAULT 0')])
+    last_race_date = DateField(verbose_name='Date of Last Race', null=True)
+
+    class Meta:
+        indexes = (
+            (('upgrade_discipline', 'year'), False),
+            (('year', 'ignore', 'last_race_date'), False),
+            (('ignore', 'last_race_date'), False),
+        )
 
     @property
     def discipline_title(self):
@@ -67,14 +108,21 @@ class Race(ObraModel):
     """
     id = IntegerField(verbose_name='Race ID', primary_key=True)
     name = CharField(verbose_name='Race Name', index=True)
-    date = DateField(verbose_name='Race Date')
+    date = DateField(verbose_name='Race Date', index=True)
     categories = JSONField(verbose_name='Race Categories')
+    category_mask = IntegerField(verbose_name='Race Categories Bitmask', default=0, index=True, constraints=[SQL('DEFAULT 0')])
+    category_min = IntegerField(verbose_name='Most Skilled Race Category', null=True)
     starters = IntegerField(verbose_name='Race Starting Field Size', default=0)
     created = DateTimeField(verbose_name='Results Created')
     updated = DateTimeField(verbose_name='Results Updated')
     event = ForeignKeyField(verbose_name='Race Event',
                             model=Event, backref='races', on_update='RESTRICT', on_delete='RESTRICT')
 
+    class Meta:
+        indexes = (
+            (('event', 'date'), False),
+        )
+
 
 class Person(ObraModel):
     """
@@ -86,6 +134,19 @@ class Person(ObraModel):
     team_name = CharField(verbose_name='Team Name', default='')
 
 
+class PersonIndex(FTS5Model):
+    """
+    Full-text index of Person names and teams for search, using the trigram tokenizer so that it
+    matches any substring of three or more characters. The rowid is the Person ID.
+    """
+    name = SearchField()
+    team_name = SearchField()
+
+    class Meta:
+        database = db
+        options = {'tokenize': 'trigram'}
+
+
 class ObraPersonSnapshot(ObraModel):
     """
     A point in time record of OBRA member data.
@@ -112,6 +173,11 @@ class ObraPersonSnapshot(ObraModel):
     def category_for_discipline(self, discipline):
         if not self.license:
             return None
+        return getattr(self, self.category_field(discipline).name)
+
+    @classmethod
+    def category_field(cls, discipline):
+        """Get the category field for an event discipline"""
         discipline = discipline.replace('mountain_bike', 'mtb')
         discipline = discipline.replace('short_track', 'mtb')
         discipline = discipline.replace('cyclocross', 'ccx')
@@ -123,7 +189,7 @@ class ObraPersonSnapshot(ObraModel):
         discipline = discipline.replace('tour', 'road')
         discipline = discipline.replace('downhill', 'dh')
         discipline = discipline.replace('super_d', 'dh')
-        return getattr(self, discipline + '_category')
+        return getattr(cls, discipline + '_category')
 
 
 class Result(ObraModel):
@@ -136,9 +202,20 @@ class Result(ObraModel):
     person = ForeignKeyField(verbose_name='Result Person',
                              model=Person, backref='results', on_update='RESTRICT', on_delete='RESTRICT', null=True)
     place = CharField(verbose_name='Place', index=True)
+    place_num = IntegerField(verbose_name='Numeric Place', null=True)
+    status = CharField(verbose_name='Finish Status', choices=[(s, s) for s in RESULT_STATUS], default='finished',
+                       constraints=[SQL("DEFAULT 'finished'")])
     time = IntegerField(verbose_name='Time', null=True)
     laps = IntegerField(verbose_name='Laps', null=True)
 
+    class Meta:
+        indexes = (
+            (('race', 'place_num'), False),
+            (('race', 'status'), False),
+            (('race', 'person'), False),
+            (('person', 'race'), False),
+        )
+
 
 class Points(ObraModel):
     """
@@ -148,11 +225,18 @@ class Points(ObraModel):
                              model=Result, backref='points', on_update='RESTRICT', on_delete='RESTRICT', primary_key=True)
     value = CharField(verbose_name='Points Earned for Result', default='0')
     notes = CharField(verbose_name='Notes', default='')
-    needs_upgrade = BooleanField(verbose_name='Needs Upgrade', default=False)
+    needs_upgrade = BooleanField(verbose_name='Needs Upgrade', default=False, index=True)
     upgrade_confirmation = ForeignKeyField(verbose_name='Member Data Confirming Upgrade',
                                            model=ObraPersonSnapshot, backref='points', null=True)
     sum_value = IntegerField(verbose_name='Current Points Sum', default=0)
     sum_categories = JSONField(verbose_name='Current Category', default=[])
+    sum_category_mask = IntegerField(verbose_name='Current Category Bitmask', default=0, constraints=[SQL('DEFAULT 0')])
+    sum_category_min = IntegerField(verbose_name='Most Skilled Current Category', null=True)
+
+    class Meta:
+        indexes = (
+            (('sum_category_min', 'sum_category_mask'), False),
+        )
 
 
 class PendingUpgrade(ObraModel):
@@ -182,10 +266,128 @@ class Quality(ObraModel):
     points_per_place = DecimalField(verbose_name='Points per Place', decimal_places=2)
 
 
-with db.connection_context():
-    db.create_tables([Series, Event, Race, Person, ObraPersonSnapshot, PendingUpgrade, Result, Points, Rank, Quality], fail_silently=True)
+class CategoryRank(ObraModel):
+    """
+    A Person's place on the rankings leaderboard for their current category in an upgrade discipline
+    """
+    discipline = CharField(verbose_name='Upgrade Discipline')
+    category = IntegerField(verbose_name='Current Category')
+    person = ForeignKeyField(verbose_name='Ranked Person',
+                             model=Person, backref='category_ranks', on_update='RESTRICT', on_delete='RESTRICT')
+    value = DecimalField(verbose_name='Rank', decimal_places=2)
+    place = IntegerField(verbose_name='Place in Category')
+
+    class Meta:
+        primary_key = CompositeKey('discipline', 'category', 'person')
+        indexes = (
+            (('discipline', 'category', 'place', 'value'), False),
+        )
+
+
+class PointsLeaderboard(ObraModel):
+    """
+    A Person's current upgrade points standing in their current category for an upgrade discipline
+    """
+    discipline = CharField(verbose_name='Upgrade Discipline')
+    category = IntegerField(verbose_name='Current Category')
+    person = ForeignKeyField(verbose_name='Person',
+                             model=Person, backref='leaderboard', on_update='RESTRICT', on_delete='RESTRICT')
+    result = ForeignKeyField(verbose_name='Most Recent Result with Points',
+                             model=Result, backref='leaderboard', on_update='RESTRICT', on_delete='RESTRICT')
+    sum_value = IntegerField(verbose_name='Current Points Sum')
+    needs_upgrade = BooleanField(verbose_name='Needs Upgrade')
+    date = DateField(verbose_name='Most Recent Race Date')
+
+    class Meta:
+        primary_key = CompositeKey('discipline', 'category', 'person')
+
+
+PointsLeaderboard.add_index(PointsLeaderboard.discipline,
+                            PointsLeaderboard.category,
+                            PointsLeaderboard.sum_value.desc(),
+                            PointsLeaderboard.person)
+
+
+class LatestResult(ObraModel):
+    """
+    A Person's most recent Result in a categorized Race for an upgrade discipline, along with their points as of that Result
+    """
+    discipline = CharField(verbose_name='Upgrade Discipline')
+    person = ForeignKeyField(verbose_name='Person',
+                             model=Person, backref='latest', on_update='RESTRICT', on_delete='RESTRICT')
+    result = ForeignKeyField(verbose_name='Most Recent Result',
+                             model=Result, backref='latest', on_update='RESTRICT', on_delete='RESTRICT')
+    date = DateField(verbose_name='Most Recent Race Date')
+    value = CharField(verbose_name='Points Earned for Result', null=True)
+    needs_upgrade = BooleanField(verbose_name='Needs Upgrade', null=True)
+    sum_value = IntegerField(verbose_name='Current Points Sum', null=True)
+    sum_categories = JSONField(verbose_name='Current Category', null=True)
+    sum_category_mask = IntegerField(verbose_name='Current Category Bitmask', null=True)
+    sum_category_min = IntegerField(verbose_name='Most Skilled Current Category', null=True)
+
+    class Meta:
+        primary_key = CompositeKey('discipline', 'person')
+        indexes = (
+            (('discipline', 'date'), False),
+            (('result', ), False),
+        )
+
+
+class UpgradeEvent(ObraModel):
+    """
+    A category change for a Person in an upgrade discipline, as detected while summing points
+    """
+    result = ForeignKeyField(verbose_name='Result at Category Change',
+                             model=Result, backref='upgrade_events', on_update='RESTRICT', on_delete='RESTRICT', primary_key=True)
+    discipline = CharField(verbose_name='Upgrade Discipline')
+    person = ForeignKeyField(verbose_name='Person',
+                             model=Person, backref='upgrade_events', on_update='RESTRICT', on_delete='RESTRICT')
+    date = DateField(verbose_name='Race Date')
+    kind = CharField(verbose_name='Upgrade or Downgrade')
+    from_category = IntegerField(verbose_name='Previous Category')
+    to_category = IntegerField(verbose_name='New Category')
+    premature = BooleanField(verbose_name='Upgraded Without Enough Points', default=False)
+    upgrade_confirmation = ForeignKeyField(verbose_name='Member Data Confirming Category Change',
+                                           model=ObraPersonSnapshot, backref='upgrade_events', null=True)
+
+    class Meta:
+        indexes = (
+            (('discipline', 'date'), False),
+            (('date', ), False),
+            (('person', ), False),
+        )
+
+
+class SchemaVersion(ObraModel):
+    """
+    A schema migration that has been applied to the database
+    """
+    version = IntegerField(verbose_name='Schema Version', primary_key=True)
+    name = CharField(verbose_name='Migration Name')
+    applied = DateTimeField(verbose_name='Applied At')
+
+
+class MaintenanceLog(ObraModel):
+    """
+    The last time a database maintenance step was run
+    """
+    step = CharField(verbose_name='Maintenance Step', primary_key=True)
+    last_run = DateTimeField(verbose_name='Last Run')
+    duration = DecimalField(verbose_name='Duration in Seconds', decimal_places=3)
+    detail = CharField(verbose_name='Detail', default='')
+
+
+class DataVersion(ObraModel):
+    """
+    A counter that is bumped whenever the data behind a tag (discipline, year, event, person) changes.
+    Used to build API cache keys, so that only the affected cache entries go stale.
+    """
+    tag = CharField(verbose_name='Tag', primary_key=True)
+    version = IntegerField(verbose_name='Version', default=0)
+    updated = DateTimeField(verbose_name='Last Updated')
+
 
-    try:
-        db.execute_sql('VACUUM')
-    except Exception as e:
-        logger.warn('Failed to vacuum database: {}'.format(e))
+# Tables are created and altered by obra_hacks.backend.migrations
+MODELS = [Series, Event, Race, Person, PersonIndex, ObraPersonSnapshot, PendingUpgrade, Result, Points, Rank, Quality,
+          CategoryRank, PointsLeaderboard, LatestResult, UpgradeEvent, SchemaVersion, MaintenanceLog,
+          DataVersion]
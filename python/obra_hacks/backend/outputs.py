@@ -2,11 +2,37 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import csv
+import gzip
+import hashlib
 import io
+import logging
+import os
+import sys
+from contextlib import ExitStack
 from datetime import datetime
 from textwrap import dedent
 
-HTML_HEADER = '''
+try:
+    import ujson as json
+    json_options = {'ensure_ascii': False, 'escape_forward_slashes': False}
+except ImportError:
+    import json
+    json_options = {'ensure_ascii': False}
+
+logger = logging.getLogger(__name__)
+
+# Reports for large disciplines run to several megabytes; buffer generously so we're not making a syscall every few rows
+BUFFER_SIZE = 1024 * 1024
+STDOUT = '/dev/stdout'
+
+TEXT_POINT = '{0:<24} | {1:>2} points in Cat {2:<3} | {3:>2} for {4:>2}/{5:<2} at [{6}]{7}: {8} on {9}  {10}\n'
+
+TEXT_PERSON_FOOTER = '-------------------------|----------------------|---------------------\n'
+
+CSV_HEADER = ['Place', 'Starters', 'Points', 'Points Total', 'First Name', 'Last Name', 'Category', 'Discipline', 'Event', 'Race', 'Date', 'Notes']
+
+HTML_HEADER = dedent('''
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -27,12 +53,12 @@ HTML_HEADER = '''
         <div class="content">
           <h2>Upgrade Points for {0}</h2>
           <div class="row event_info">
-            <a href="upgrades.csv">Download Raw CSV</a>
+            <a href="{2}">{3}</a>
           </div>
           <p class="created_updated">Updated {1}</p>
-    <!-- Start Content -->'''
+    <!-- Start Content -->''')
 
-HTML_UPGRADES_HEADER = '''
+HTML_UPGRADES_HEADER = dedent('''
     <!-- Start Upgrades -->
           <div class="event_info">
             <h4 class="race">Upgrades Due</h4>
@@ -45,28 +71,28 @@ HTML_UPGRADES_HEADER = '''
                   <th class="date pull-right">Date</th>
                 </tr>
               </thead>
-              <tbody>'''
+              <tbody>''')
 
-HTML_UPGRADE = '''
+HTML_UPGRADE = dedent('''
     <!-- Upgrade -->
                 <tr>
                   <td class="race">{sum_categories}</td>
                   <td class="race">
-                    <a href="#person_{point.result.person.id}">
+                    <a href="{href}">
                         {point.result.person.first_name} {point.result.person.last_name}
                       </a>
                   </td>
                   <td class="points_total">{point.sum_value}</td>
                   <td class="date">{point.last_date}</td>
-                </tr>'''
+                </tr>''')
 
-HTML_UPGRADES_FOOTER = '''
+HTML_UPGRADES_FOOTER = dedent('''
     <!-- End Upgrades -->
               </tbody>
             </table>
-          </div>'''
+          </div>''')
 
-HTML_PERSON_HEADER = '''
+HTML_PERSON_HEADER = dedent('''
     <!-- Start Person -->
           <h3 class="race" id="person_{0.id}"><a href="#person_{0.id}">{0.first_name} {0.last_name}</a></h3>
           <table class="base table table-striped results">
@@ -83,9 +109,9 @@ HTML_PERSON_HEADER = '''
                 <th class="notes">Notes</th>
               </tr>
             </thead>
-            <tbody>'''
+            <tbody>''')
 
-HTML_POINT = '''
+HTML_POINT = dedent('''
     <!-- Point -->
               <tr>
                 <td class="place">{point.result.place}</td>
@@ -101,14 +127,14 @@ HTML_POINT = '''
                 <td class="place">{sum_categories}</td>
                 <td class="date hidden-xs">{point.result.race.date}</td>
                 <td class="notes text-nowrap">{point.notes}</td>
-              </tr>'''
+              </tr>''')
 
-HTML_PERSON_FOOTER = '''
+HTML_PERSON_FOOTER = dedent('''
     <!-- End Person -->
             </tbody>
-          </table>'''
+          </table>''')
 
-HTML_FOOTER = '''
+HTML_FOOTER = dedent('''
     <!-- End Content -->
         </div>
       </div>
@@ -120,13 +146,45 @@ HTML_FOOTER = '''
         </footer>
       </div>
     </body>
-    </html>'''
+    </html>''')
+
+
+def format_categories(categories):
+    return '/'.join(str(c) for c in categories)
+
+
+def place_value(place):
+    """Numeric places are output as numbers, anything else (DNF, DQ) as a string"""
+    return int(place) if place.isdigit() else place
+
+
+def point_data(point):
+    """JSON-serializable representation of a single point"""
+    race = point.result.race
+    return {'place': place_value(point.result.place),
+            'starters': race.starters,
+            'points': int(point.value),
+            'point_total': point.sum_value,
+            'category': format_categories(point.sum_categories),
+            'discipline': race.event.discipline,
+            'event': race.event.name,
+            'race': race.name,
+            'date': str(race.date),
+            'notes': point.notes,
+            }
 
 
 class OutputBase(object):
-    def __init__(self, discipline, path='/dev/stdout'):
+    def __init__(self, discipline, path=STDOUT):
         self.discipline = discipline
-        self.output = io.TextIOWrapper(io.open(path, 'wb'))
+        self.stdout = path == STDOUT
+        if self.stdout:
+            # Write through our own stdout rather than reopening /dev/stdout, which would truncate it
+            # if it's redirected to a file. It's detached rather than closed when we're done, so it can be reused.
+            sys.stdout.flush()
+            self.output = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+        else:
+            self.output = io.open(path, 'w', buffering=BUFFER_SIZE, encoding='utf-8', newline='')
 
     def __enter__(self):
         if hasattr(self, 'header'):
@@ -158,8 +216,14 @@ class OutputBase(object):
         pass
 
     def __exit__(self, type, value, traceback):
-        if hasattr(self, 'footer'):
-            self.footer()
+        try:
+            if hasattr(self, 'footer'):
+                self.footer()
+        finally:
+            if self.stdout:
+                self.output.detach()
+            else:
+                self.output.close()
         return None
 
 
@@ -169,122 +233,271 @@ class TextOutput(OutputBase):
             self.discipline.capitalize()))
 
     def point(self, point):
-        if point.notes:
-            point.notes = '*** {} ***'.format(point.notes)
-        self.output.write('{0:<24} | {1:>2} points in Cat {2:<3} | {3:>2} for {4:>2}/{5:<2} at [{6}]{7}: {8} on {9}  {10}\n'.format(
-            ', '.join([point.result.person.last_name, point.result.person.first_name]),
+        result = point.result
+        race = result.race
+        self.output.write(TEXT_POINT.format(
+            ', '.join([result.person.last_name, result.person.first_name]),
             point.sum_value,
-            '/'.join(str(c) for c in point.sum_categories),
+            format_categories(point.sum_categories),
             point.value,
-            point.result.place,
-            point.result.race.starters,
-            point.result.race.event.discipline_title,
-            point.result.race.event.name,
-            point.result.race.name,
-            point.result.race.date,
-            point.notes))
+            result.place,
+            race.starters,
+            race.event.discipline_title,
+            race.event.name,
+            race.name,
+            race.date,
+            '*** {} ***'.format(point.notes) if point.notes else point.notes))
 
     def end_person(self, person, final=False):
         if not final:
-            self.output.write('-------------------------|----------------------|---------------------\n')
+            self.output.write(TEXT_PERSON_FOOTER)
 
 
 class HtmlOutput(OutputBase):
     def header(self):
-        self.output.write(dedent(HTML_HEADER).format(self.discipline.capitalize(), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        self.output.write(HTML_HEADER.format(self.discipline.capitalize(), datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                             'upgrades.csv', 'Download Raw CSV'))
 
     def start_upgrades(self):
-        self.output.write(dedent(HTML_UPGRADES_HEADER))
+        self.output.write(HTML_UPGRADES_HEADER)
 
     def upgrade(self, point):
-        self.output.write(dedent(HTML_UPGRADE).format(
+        self.output.write(HTML_UPGRADE.format(
             point=point,
-            sum_categories='/'.join(str(c) for c in point.sum_categories)))
+            href='#person_{}'.format(point.result.person.id),
+            sum_categories=format_categories(point.sum_categories)))
 
     def end_upgrades(self):
-        self.output.write(dedent(HTML_UPGRADES_FOOTER))
+        self.output.write(HTML_UPGRADES_FOOTER)
 
     def start_person(self, person):
-        self.output.write(dedent(HTML_PERSON_HEADER).format(person))
+        self.output.write(HTML_PERSON_HEADER.format(person))
 
     def point(self, point):
-        self.output.write(dedent(HTML_POINT).format(
+        self.output.write(HTML_POINT.format(
             point=point,
-            sum_categories='/'.join(str(c) for c in point.sum_categories)))
+            sum_categories=format_categories(point.sum_categories)))
 
     def end_person(self, person, final=False):
-        self.output.write(dedent(HTML_PERSON_FOOTER))
+        self.output.write(HTML_PERSON_FOOTER)
 
     def footer(self):
-        self.output.write(dedent(HTML_FOOTER))
+        self.output.write(HTML_FOOTER)
 
 
 class JsonOutput(OutputBase):
+    """
+    Streams a single JSON document, one person and one point at a time.
+    Separators are written ahead of each item, so nothing needs to be held back waiting to see if it was the last one.
+    """
     def header(self):
-        self.output.write('{\n')
-        self.output.write('  "discipline": "{}",\n'.format(self.discipline))
-        self.output.write('  "people": [\n')
+        self.output.write('{{\n  "discipline": {},\n  "people": ['.format(json.dumps(self.discipline, **json_options)))
+        self.person_separator = '\n'
 
     def start_person(self, person):
-        self.point_buffer = ''
-        self.output.write('    {\n')
-        self.output.write('      "first_name": "{}",\n'.format(person.first_name))
-        self.output.write('      "last_name": "{}",\n'.format(person.last_name))
-        self.output.write('      "points": [\n')
+        self.output.write('{}    {{\n      "first_name": {},\n      "last_name": {},\n      "points": ['.format(
+            self.person_separator,
+            json.dumps(person.first_name, **json_options),
+            json.dumps(person.last_name, **json_options)))
+        self.person_separator = ',\n'
+        self.point_separator = '\n'
 
     def point(self, point):
-        if self.point_buffer:
-            self.output.write(self.point_buffer + ',\n')
-
-        self.point_buffer = '        { '
-        self.point_buffer += '"place": {}, "starters": {}, "points": {}, "point_total": {}, '.format(
-            point.result.place,
-            point.result.race.starters,
-            point.value,
-            point.sum_value)
-        self.point_buffer += '"category": "{}", "discipline": "{}", "event": "{}", "race": "{}", "date": "{}", "notes": "{}" '.format(
-            '/'.join(str(c) for c in point.sum_categories),
-            point.result.race.event.discipline,
-            point.result.race.event.name,
-            point.result.race.name,
-            point.result.race.date,
-            point.notes)
-        self.point_buffer += '}'
+        self.output.write(self.point_separator)
+        self.output.write('        ')
+        self.output.write(json.dumps(point_data(point), **json_options))
+        self.point_separator = ',\n'
 
     def end_person(self, person, final=False):
-        self.output.write(self.point_buffer + '\n')
-        self.output.write('      ]\n')
-        self.output.write('    }' + ('\n' if final else ',\n'))
+        self.output.write('\n      ]\n    }')
 
     def footer(self):
-        self.output.write('  ]\n')
-        self.output.write('}\n')
+        self.output.write('\n  ]\n}\n')
 
 
 class CsvOutput(OutputBase):
     def header(self):
-        self.output.write('Place, Starters, Points, Points Total, First Name, Last Name, Category, Discipline, Event, Race, Date, Notes\n')
+        self.writer = csv.writer(self.output, lineterminator='\n')
+        self.writer.writerow(CSV_HEADER)
 
     def point(self, point):
-        self.output.write('{0},{1:>2},{2:>2},{3:>2},"{4}"\t,"{5}"\t,"{6}"\t,"{7}"\t,"{8}"\t,"{9}"\t,{10},"{11}"\n'.format(
-            point.result.place,
-            point.result.race.starters,
-            point.value,
-            point.sum_value,
-            point.result.person.first_name,
-            point.result.person.last_name,
-            '/'.join(str(c) for c in point.sum_categories),
-            point.result.race.event.discipline_title,
-            point.result.race.event.name,
-            point.result.race.name,
-            point.result.race.date,
-            point.notes))
+        result = point.result
+        race = result.race
+        self.writer.writerow([result.place,
+                              race.starters,
+                              point.value,
+                              point.sum_value,
+                              result.person.first_name,
+                              result.person.last_name,
+                              format_categories(point.sum_categories),
+                              race.event.discipline_title,
+                              race.event.name,
+                              race.name,
+                              race.date,
+                              point.notes])
+
+
+class PeopleOutput(OutputBase):
+    """
+    Writes a static page (HTML and JSON) for each person into a directory, along with an index of people who need upgrades.
+    Each file also gets a precompressed .gz copy for uwsgi's static-gzip-all.
+    Pages are only rewritten when the person's points have changed since the last run; a hash of
+    each person's data is kept in a manifest in the output directory to track this.
+    """
+    manifest_name = '.manifest.json'
+
+    def __init__(self, discipline, path):
+        self.discipline = discipline
+        self.path = path
+        self.people_path = os.path.join(path, 'people')
+        os.makedirs(self.people_path, exist_ok=True)
+        try:
+            with io.open(os.path.join(path, self.manifest_name), encoding='utf-8') as f:
+                self.old_hashes = json.load(f)
+        except (IOError, ValueError):
+            self.old_hashes = {}
+        self.hashes = {}
+        self.upgrades = []
+        self.upgrade_points = []
+        self.written = 0
+
+    def upgrade(self, point):
+        person = point.result.person
+        self.upgrades.append({'id': person.id,
+                              'first_name': person.first_name,
+                              'last_name': person.last_name,
+                              'category': format_categories(point.sum_categories),
+                              'point_total': point.sum_value,
+                              'date': str(point.last_date),
+                              })
+        self.upgrade_points.append(point)
+
+    def end_upgrades(self):
+        data = self.encode({'discipline': self.discipline, 'upgrades': self.upgrades})
+        if self.changed('index', data, 'index.json'):
+            html = [HTML_HEADER.format(self.discipline.capitalize(), self.now(), 'index.json', 'Download Raw JSON'),
+                    HTML_UPGRADES_HEADER]
+            html.extend(HTML_UPGRADE.format(point=point,
+                                            href='people/{}.html'.format(point.result.person.id),
+                                            sum_categories=format_categories(point.sum_categories))
+                        for point in self.upgrade_points)
+            html.extend([HTML_UPGRADES_FOOTER, HTML_FOOTER])
+            self.written += 1
+            self.write('index.json', data)
+            self.write('index.html', ''.join(html).encode('utf-8'))
+
+    def start_person(self, person):
+        self.points = []
+
+    def point(self, point):
+        self.points.append(point)
+
+    def end_person(self, person, final=False):
+        data = self.encode({'discipline': self.discipline,
+                            'id': person.id,
+                            'first_name': person.first_name,
+                            'last_name': person.last_name,
+                            'points': [point_data(point) for point in self.points],
+                            })
+        if self.changed(str(person.id), data, os.path.join('people', '{}.json'.format(person.id))):
+            title = '{}: {} {}'.format(self.discipline.capitalize(), person.first_name, person.last_name)
+            html = [HTML_HEADER.format(title, self.now(), '../index.html', 'All Upgrades'),
+                    HTML_PERSON_HEADER.format(person)]
+            html.extend(HTML_POINT.format(point=point, sum_categories=format_categories(point.sum_categories))
+                        for point in self.points)
+            html.extend([HTML_PERSON_FOOTER, HTML_FOOTER])
+            self.written += 1
+            self.write(os.path.join('people', '{}.json'.format(person.id)), data)
+            self.write(os.path.join('people', '{}.html'.format(person.id)), ''.join(html).encode('utf-8'))
+
+    def __exit__(self, type, value, traceback):
+        if type is not None:
+            return None
+
+        # Remove pages for anyone who no longer has points
+        for key in set(self.old_hashes) - set(self.hashes):
+            for ext in ['json', 'json.gz', 'html', 'html.gz']:
+                try:
+                    os.remove(os.path.join(self.people_path, '{}.{}'.format(key, ext)))
+                except OSError:
+                    pass
+
+        self.write(self.manifest_name, self.encode(self.hashes), compress=False)
+        logger.info('Wrote {} of {} {} pages to {}'.format(self.written, len(self.hashes), self.discipline, self.path))
+        return None
+
+    def changed(self, key, data, name):
+        self.hashes[key] = hashlib.sha1(data).hexdigest()
+        return self.hashes[key] != self.old_hashes.get(key) or not os.path.exists(os.path.join(self.path, name))
+
+    def encode(self, data):
+        return json.dumps(data, **json_options).encode('utf-8')
+
+    def now(self):
+        return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def write(self, name, data, compress=True):
+        """Replace files by renaming them into place, so that uwsgi never serves a partially written page"""
+        files = [(name, data)]
+        if compress:
+            files.append((name + '.gz', gzip.compress(data, mtime=0)))
+
+        for file_name, file_data in files:
+            file_path = os.path.join(self.path, file_name)
+            with io.open(file_path + '.tmp', 'wb') as f:
+                f.write(file_data)
+            os.replace(file_path + '.tmp', file_path)
+
+
+class MultiOutput(object):
+    """
+    Fans each call out to several writers, so that a single pass over the data can produce multiple reports.
+    """
+    def __init__(self, writers):
+        self.writers = writers
+        self.stack = ExitStack()
+
+    def __enter__(self):
+        # If a writer fails to start, close the ones that already have before giving up
+        with ExitStack() as stack:
+            for writer in self.writers:
+                stack.enter_context(writer)
+            self.stack = stack.pop_all()
+        return self
+
+    def start_upgrades(self):
+        for writer in self.writers:
+            writer.start_upgrades()
+
+    def upgrade(self, point):
+        for writer in self.writers:
+            writer.upgrade(point)
+
+    def end_upgrades(self):
+        for writer in self.writers:
+            writer.end_upgrades()
+
+    def start_person(self, person):
+        for writer in self.writers:
+            writer.start_person(person)
+
+    def point(self, point):
+        for writer in self.writers:
+            writer.point(point)
+
+    def end_person(self, person, final=False):
+        for writer in self.writers:
+            writer.end_person(person, final)
+
+    def __exit__(self, type, value, traceback):
+        return self.stack.__exit__(type, value, traceback)
 
 
 OUTPUT_MAP = {'text': TextOutput,
               'html': HtmlOutput,
               'json': JsonOutput,
               'csv': CsvOutput,
+              'people': PeopleOutput,
               'null': OutputBase,
               }
 
@@ -294,3 +507,15 @@ def get_writer(output_format, *args, **kwargs):
         return OUTPUT_MAP[output_format](*args, **kwargs)
     else:
         raise NotImplementedError()
+
+
+def get_writers(discipline, outputs):
+    """
+    Get a single writer for a list of (output_format, path) pairs.
+    Paths may contain a {discipline} placeholder, so that the same outputs can be used for several disciplines.
+    """
+    writers = [get_writer(output_format, discipline, path.format(discipline=discipline)) for output_format, path in outputs]
+    if len(writers) == 1:
+        return writers[0]
+    else:
+        return MultiOutput(writers)
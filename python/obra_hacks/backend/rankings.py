@@ -6,22 +6,72 @@ import logging
 from collections import defaultdict
 from datetime import date
 
-from peewee import fn
+from peewee import chunked, fn
 
-from .data import DISCIPLINE_MAP
-from .models import Event, Quality, Race, Rank, Result
+from .models import (CategoryRank, Event, PointsLeaderboard, Quality, Race,
+                     Rank, Result, db)
 
 try:
     import ujson as json
 except ImportError:
     import json
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 logger = logging.getLogger(__name__)
 
 
-def get_ranks(upgrade_discipline, end_date=None, person_ids=[]):
+class Ranks(dict):
     """
-    Return a dict of everyone's rank for this discipline as of a given date
+    Mapping of Person ID to rank. People without any ranked results get the default rank.
+    Unlike a defaultdict, looking up an unranked person does not add them to the mapping.
+    """
+    default = 600
+
+    def __missing__(self, key):
+        return self.default
+
+
+def best_ranks(person_ids, values, offsets, count=5, default=600):
+    """
+    Average each person's best (lowest) ranks.
+    Rank values for each person are stored back to back in values; person_ids[i] owns values[offsets[i]:offsets[i+1]].
+    Everyone is padded out to count ranks with the default value, so people with only a few results are penalized.
+    """
+    if np is None:
+        default_ranks = [default] * count
+        return Ranks((person_id, sum(sorted(default_ranks + values[offsets[i]:offsets[i + 1]])[:count]) / count)
+                     for i, person_id in enumerate(person_ids))
+
+    if not person_ids:
+        return Ranks()
+
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.intp)
+    lengths = np.diff(offsets)
+
+    # Scatter the flat values into a matrix with one row per person, with enough default padding
+    # on every row that the smallest N values in each row match the smallest N of values + padding.
+    matrix = np.full((len(person_ids), lengths.max() + count), default, dtype=np.float64)
+    rows = np.repeat(np.arange(len(person_ids)), lengths)
+    matrix[rows, np.arange(len(values)) - offsets[rows]] = values
+
+    # Partial sort to find the best N, then sort just those so that they're summed
+    # in the same order as the pure-Python version and produce identical averages.
+    best = np.sort(np.partition(matrix, count - 1, axis=1)[:, :count], axis=1)
+    total = best[:, 0].copy()
+    for i in range(1, count):
+        total += best[:, i]
+
+    return Ranks(zip(person_ids, (total / count).tolist()))
+
+
+def get_rank_dates(end_date=None):
+    """
+    Get the (start_date, end_date) range of results that count toward a rank as of a given date
     """
     year_range = 1
     if not end_date:
@@ -29,29 +79,81 @@ def get_ranks(upgrade_discipline, end_date=None, person_ids=[]):
     if end_date.year == 2021:
         # f*ck 2020
         year_range = 2
-    start_date = end_date.replace(end_date.year - year_range)
+    return (end_date.replace(end_date.year - year_range), end_date)
+
+
+def get_recent_date():
+    """
+    Get the start of the period that counts as recent activity - jan 1 of the previous year
+    """
+    start_year = date.today().year - 1
+    if start_year == 2020:
+        start_year = 2019  # f*ck 2020
+    return date(start_year, 1, 1)
+
+
+def get_ranks(upgrade_discipline, end_date=None, person_ids=[]):
+    """
+    Return a dict of everyone's rank for this discipline as of a given date
+    """
+    start_date, end_date = get_rank_dates(end_date)
 
-    default_ranks = [600] * 5
     query = (Rank.select(Result.person_id, fn.json_group_array(Rank.value).python_value(json.loads))
                  .join(Result, src=Rank)
                  .join(Race, src=Result)
                  .join(Event, src=Race)
                  .where(Race.date >= start_date)
                  .where(Race.date < end_date)
-                 .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                 .where(Event.upgrade_discipline == upgrade_discipline)
                  .group_by(Result.person_id))
 
     if person_ids:
         query = query.where(Result.person_id << person_ids)
 
-    logger.debug('Got {} People in {} between {} and {}'.format(query.count(), upgrade_discipline, start_date, end_date))
-    return defaultdict(lambda: 600, ((person_id, sum(sorted(default_ranks + ranks)[:5]) / 5) for person_id, ranks in query.tuples()))
+    ids = []
+    values = []
+    offsets = [0]
+    for person_id, ranks in query.tuples():
+        ids.append(person_id)
+        values.extend(ranks)
+        offsets.append(len(values))
+
+    logger.debug('Got {} People in {} between {} and {}'.format(len(ids), upgrade_discipline, start_date, end_date))
+    return best_ranks(ids, values, offsets)
+
+
+def get_discipline_ranks(person_ids, end_date=None):
+    """
+    Return a dict of upgrade discipline to the ranks of some people as of a given date,
+    aggregated across all disciplines at once. Disciplines they have no ranks in get an empty Ranks.
+    """
+    start_date, end_date = get_rank_dates(end_date)
+
+    query = (Rank.select(Event.upgrade_discipline,
+                         Result.person_id,
+                         fn.json_group_array(Rank.value).python_value(json.loads))
+                 .join(Result, src=Rank)
+                 .join(Race, src=Result)
+                 .join(Event, src=Race)
+                 .where(Race.date >= start_date)
+                 .where(Race.date < end_date)
+                 .where(Result.person_id << person_ids)
+                 .group_by(Event.upgrade_discipline, Result.person_id))
+
+    grouped = defaultdict(lambda: ([], [], [0]))
+    for upgrade_discipline, person_id, ranks in query.tuples():
+        ids, values, offsets = grouped[upgrade_discipline]
+        ids.append(person_id)
+        values.extend(ranks)
+        offsets.append(len(values))
+
+    return defaultdict(Ranks, ((d, best_ranks(*g)) for d, g in grouped.items()))
 
 
 def calculate_race_ranks(upgrade_discipline, incremental=False):
     # Delete all Rank and Quality data for this discipline and recalc from scratch
 
-    category_filter = (Race.categories.length() != 0)
+    category_filter = (Race.category_mask > 0)
     if upgrade_discipline == 'cyclocross':
         category_filter |= ((Race.name ** '%single%') & ~(Race.name ** '%person%'))
 
@@ -60,13 +162,13 @@ def calculate_race_ranks(upgrade_discipline, incremental=False):
              .where(Rank.result_id << (Result.select(Result.id)
                                              .join(Race, src=Result)
                                              .join(Event, src=Race)
-                                             .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])))
+                                             .where(Event.upgrade_discipline == upgrade_discipline)))
              .execute())
 
         (Quality.delete()
                 .where(Quality.race_id << (Race.select(Race.id)
                                                .join(Event, src=Race)
-                                               .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])))
+                                               .where(Event.upgrade_discipline == upgrade_discipline)))
                 .execute())
 
     prev_race = Race()
@@ -75,8 +177,8 @@ def calculate_race_ranks(upgrade_discipline, incremental=False):
                  .where(Race.id.not_in(Quality.select(fn.DISTINCT(Race.id))
                                               .join(Race, src=Quality)
                                               .join(Event, src=Race)
-                                              .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])))
-                 .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                                              .where(Event.upgrade_discipline == upgrade_discipline)))
+                 .where(Event.upgrade_discipline == upgrade_discipline)
                  .where(category_filter)
                  .order_by(Race.date.asc(), Race.created.asc()))
 
@@ -91,8 +193,7 @@ def calculate_race_ranks(upgrade_discipline, incremental=False):
         logger.info('Processing Race: [{}]{}: [{}]{} on {}'.format(race.event.id, race.event.name, race.id, race.name, race.date))
 
         results = (race.results.select()
-                               .where(~(Result.place.contains('dns')))
-                               .where(~(Result.place.contains('dnf')))
+                               .where(Result.status.not_in(['dns', 'dnf']))
                                .order_by(Result.id.asc()))
         finishers = results.count()
 
@@ -131,3 +232,44 @@ def calculate_race_ranks(upgrade_discipline, incremental=False):
 
         Rank.insert_many(insert_ranks, fields=[Rank.result, Rank.value]).on_conflict_replace().execute()
         prev_race = race
+
+
+@db.savepoint()
+def calculate_category_ranks(upgrade_discipline):
+    """
+    Build per-category rank leaderboards, using each person's current category from the points leaderboard.
+    People with multiple possible categories (3/4, etc) are placed on the leaderboard for each of them.
+    Must be run after sum_points, since that's where the categories come from.
+    """
+    logger.info('Calculating category ranks - upgrade_discipline={}'.format(upgrade_discipline))
+
+    categories = defaultdict(list)
+    query = (PointsLeaderboard.select(PointsLeaderboard.person_id, PointsLeaderboard.category)
+                              .where(PointsLeaderboard.discipline == upgrade_discipline))
+    for person_id, category in query.tuples():
+        categories[person_id].append(category)
+
+    leaderboards = defaultdict(list)
+    for person_id, rank in get_ranks(upgrade_discipline).items():
+        for category in categories.get(person_id, []):
+            leaderboards[category].append((rank, person_id))
+
+    rows = []
+    for category, ranks in leaderboards.items():
+        place = 0
+        prev_rank = 0
+        for rank, person_id in sorted(ranks):
+            place += int(rank) != prev_rank
+            prev_rank = int(rank)
+            rows.append((upgrade_discipline, category, person_id, rank, place))
+
+    (CategoryRank.delete()
+                 .where(CategoryRank.discipline == upgrade_discipline)
+                 .execute())
+
+    for batch in chunked(rows, 500):
+        (CategoryRank.insert_many(batch, fields=[CategoryRank.discipline, CategoryRank.category, CategoryRank.person,
+                                                 CategoryRank.value, CategoryRank.place])
+                     .execute())
+
+    logger.info('Ranked {} People in {} categories'.format(len(rows), len(leaderboards)))
@@ -3,19 +3,24 @@
 from __future__ import unicode_literals
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
 
 import requests
 from lxml import html
-from peewee import EXCLUDED, JOIN, fn
+from peewee import EXCLUDED, JOIN, chunked, fn
 
 from .data import (AGE_RANGE_RE, CATEGORY_RE, DISCIPLINE_MAP,
-                   DISCIPLINE_RE_MAP, STANDINGS_RE)
-from .models import Event, ObraPersonSnapshot, Person, Race, Result, Series, db
+                   DISCIPLINE_RE_MAP, STANDINGS_RE, UPGRADE_DISCIPLINE_MAP)
+from .models import (Event, ObraPersonSnapshot, Person, PersonIndex, Race,
+                     Result, Series, category_mask, db, place_number,
+                     place_status)
+from .versions import tag, touch, touch_event
 
 session = requests.Session()
 logger = logging.getLogger(__name__)
 baseurl = 'https://obra.org'
+scrape_workers = 8
 
 
 @db.savepoint()
@@ -62,12 +67,13 @@ def scrape_year(year, upgrade_discipline):
                     (Event.insert(id=event_id,
                                   name=event_name,
                                   discipline=event_discipline,
+                                  upgrade_discipline=UPGRADE_DISCIPLINE_MAP.get(event_discipline),
                                   year=year,
                                   date=event_date,
                                   series_id=parent_id,
                                   parent_id=None)
                           .on_conflict(conflict_target=[Event.id],
-                                       preserve=[Event.name, Event.discipline, Event.year, Event.date, Event.series, Event.parent])
+                                       preserve=[Event.name, Event.discipline, Event.upgrade_discipline, Event.year, Event.date, Event.series, Event.parent])
                           .execute())
                 else:
                     logger.warn('Found multi-day-event-child without a series!')
@@ -90,12 +96,13 @@ def scrape_year(year, upgrade_discipline):
                     (Event.insert(id=event_id,
                                   name=event_name,
                                   discipline=event_discipline,
+                                  upgrade_discipline=UPGRADE_DISCIPLINE_MAP.get(event_discipline),
                                   year=year,
                                   date=event_date,
                                   series_id=None,
                                   parent_id=None)
                           .on_conflict(conflict_target=[Event.id],
-                                       preserve=[Event.name, Event.discipline, Event.year, Event.date, Event.series, Event.parent])
+                                       preserve=[Event.name, Event.discipline, Event.upgrade_discipline, Event.year, Event.date, Event.series, Event.parent])
                           .execute())
 
 
@@ -114,8 +121,8 @@ def scrape_parents(year, upgrade_discipline):
                   .where(Event.parent_id.is_null(True))
                   .where(Event.id.not_in(Event.select(Event.parent_id)
                                               .where(Event.year == year)
-                                              .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])))
-                  .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                                              .where(Event.upgrade_discipline == upgrade_discipline)))
+                  .where(Event.upgrade_discipline == upgrade_discipline)
                   .group_by(Event.id)
                   .having(fn.COUNT(Race.id) == 0))
 
@@ -132,7 +139,7 @@ def scrape_new(upgrade_discipline):
     query = (Event.select()
                   .join(Race, src=Event, join_type=JOIN.LEFT_OUTER)
                   .where(Event.ignore == False)
-                  .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                  .where(Event.upgrade_discipline == upgrade_discipline)
                   .group_by(Event.id)
                   .having(fn.COUNT(Race.id) == 0))
 
@@ -155,7 +162,7 @@ def scrape_recent(upgrade_discipline, days):
                           fn.MAX(Race.updated).alias('updated'))
                   .join(Race, src=Event)
                   .where(Event.ignore == False)
-                  .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                  .where(Event.upgrade_discipline == upgrade_discipline)
                   .group_by(Event.id)
                   .having(Race.updated > update_threshold))
 
@@ -191,12 +198,14 @@ def scrape_parent_event(event):
         change_count += (Event.insert(id=event_id,
                                       name=event_name,
                                       discipline=event_discipline,
+                                      upgrade_discipline=UPGRADE_DISCIPLINE_MAP.get(event_discipline),
                                       year=event.year,
                                       date=event.date,
                                       series_id=event.series_id,
                                       parent_id=event.id)
                               .on_conflict(conflict_target=[Event.id],
-                                           preserve=[Event.name, Event.discipline, Event.year, Event.date, Event.series, Event.parent])
+                                           preserve=[Event.name, Event.discipline, Event.upgrade_discipline, Event.year,
+                                                     Event.date, Event.series, Event.parent])
                               .execute())
 
     return change_count
@@ -215,12 +224,16 @@ def scrape_event(event):
         logger.warning('Skipping and ignoring Event: has no results!')
         event.ignore = True
         event.save()
+        touch_event(event, get_race_people(Race.select(Race.id).where(Race.event_id == event.id)))
         Result.delete().where(Result.race_id << (Race.select(Race.id).where(Race.event_id == event.id))).execute()
-        return Race.delete().where(Race.event_id == event.id).execute()
+        race_count = Race.delete().where(Race.event_id == event.id).execute()
+        update_event_summary([event.id])
+        return race_count
 
     change_count = 0
     people = dict()
     races = dict()
+    deleted_people = set()
 
     for result in results:
         # Do some preflight checks the first time we see a row with a new race_id
@@ -254,13 +267,17 @@ def scrape_event(event):
                         continue
                 else:
                     logger.info('Deleting old race [{}]{}'.format(prev_race.id, prev_race.name))
+                    deleted_people.update(get_race_people([prev_race.id]))
                     prev_race.delete_instance(recursive=True)
 
+            categories = get_categories(result['race_name'], event.discipline)
             (Race.insert(id=result['race_id'],
                          event_id=result['event_id'],
                          name=result['race_name'],
                          date=result['date'],
-                         categories=get_categories(result['race_name'], event.discipline),
+                         categories=categories,
+                         category_mask=category_mask(categories),
+                         category_min=min(categories, default=None),
                          created=created,
                          updated=updated)
                  .execute())
@@ -294,6 +311,8 @@ def scrape_event(event):
                        race_id=result['race_id'],
                        person_id=result['person_id'],
                        place=result['place'],
+                       place_num=place_number(result['place']),
+                       status=place_status(result['place']),
                        time=result['time'],
                        laps=result['laps'])
                .execute())
@@ -304,7 +323,7 @@ def scrape_event(event):
     for race_id, scrape_flag in races.items():
         if scrape_flag:
             starters = (Result.select()
-                              .where(~(Result.place.contains('dns')))
+                              .where(Result.status != 'dns')
                               .where(Result.race_id == race_id)
                               .count())
             logger.info('Counted {} starters for race [{}]'.format(starters, race_id))
@@ -317,8 +336,14 @@ def scrape_event(event):
     for prev_race in event.races.select(Race.id, Race.name).where(Race.id.not_in([r for r in races])):
         logger.info('Deleting orphan race [{}]{}'.format(prev_race.id, prev_race.name))
         change_count += 1
+        deleted_people.update(get_race_people([prev_race.id]))
         prev_race.delete_instance(recursive=True)
 
+    if change_count:
+        update_event_summary({event.id}.union(r['event_id'] for r in results))
+        index_people(people)
+        touch_event(event, deleted_people.union(people))
+
     logger.info('Event scrape modified {} Races'.format(change_count))
     return change_count
 
@@ -328,20 +353,60 @@ def clean_events(year, upgrade_discipline):
     race_count = 0
     query = (Event.select()
                   .where(Event.year == year)
-                  .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline]))
+                  .where(Event.upgrade_discipline == upgrade_discipline))
 
     for event in query:
         if STANDINGS_RE.search(event.name):
             logger.info('Ignoring Event: [{}]{} on {}/{}'.format(event.id, event.name, event.year, event.date))
             event.ignore = True
             event.save()
+            touch_event(event, get_race_people(event.races.select(Race.id)))
             for race in event.races.select(Race.id):
                 race.delete_instance(recursive=True)
                 race_count += 1
+            update_event_summary([event.id])
 
     return race_count
 
 
+def update_event_summary(event_ids):
+    """
+    Recalculate the Race count and last Race date stored on each Event.
+    This needs to be called whenever Races are added to or removed from an Event.
+    """
+    races = Race.alias()
+    (Event.update({Event.race_count: (races.select(fn.COUNT(races.id))
+                                           .where(races.event_id == Event.id)),
+                   Event.last_race_date: (races.select(fn.MAX(races.date))
+                                               .where(races.event_id == Event.id)),
+                   })
+          .where(Event.id << list(event_ids))
+          .execute())
+
+
+def index_people(person_ids):
+    """
+    Update the search index for these People from their current name and team
+    """
+    for batch in chunked(set(person_ids), 500):
+        PersonIndex.delete().where(PersonIndex.rowid << batch).execute()
+        (PersonIndex.insert_from(Person.select(Person.id,
+                                               Person.first_name.concat(' ').concat(Person.last_name),
+                                               Person.team_name)
+                                       .where(Person.id << batch),
+                                 [PersonIndex.rowid, PersonIndex.name, PersonIndex.team_name])
+                    .execute())
+
+
+def get_race_people(race_ids):
+    """Get the IDs of everyone with Results in these Races"""
+    query = (Result.select(Result.person_id)
+                   .where(Result.race_id << race_ids)
+                   .distinct()
+                   .tuples())
+    return [person_id for person_id, in query]
+
+
 def find_person(name):
     """
     Sometimes results come through with the name mangled and a new id.
@@ -369,6 +434,27 @@ def find_person(name):
 
 @db.savepoint()
 def scrape_person(person):
+    (ObraPersonSnapshot.insert(**fetch_person(person))
+                       .execute())
+    touch([tag('person', person.id)])
+
+
+@db.savepoint()
+def scrape_people(people):
+    """
+    Scrape OBRA member data for several people at once.
+    Pages are fetched concurrently; snapshots are saved from the calling thread, since the database connection isn't shared.
+    """
+    logger.info('Scraping Person data for {} People'.format(len(people)))
+    with ThreadPoolExecutor(max_workers=scrape_workers) as executor:
+        for kwargs in executor.map(fetch_person, people):
+            (ObraPersonSnapshot.insert(**kwargs)
+                               .execute())
+    touch(tag('person', person.id) for person in people)
+
+
+def fetch_person(person):
+    """Fetch and parse OBRA member data for a person, without touching the database"""
     logger.info('Scraping Person data for {}'.format(person.id))
     response = session.get('{}/people/{}/1900'.format(baseurl, person.id))
     response.raise_for_status()
@@ -385,8 +471,7 @@ def scrape_person(person):
                 value = 0
             kwargs[attr] = value
 
-    (ObraPersonSnapshot.insert(**kwargs)
-                       .execute())
+    return kwargs
 
 
 def get_categories(race_name, event_discipline):
@@ -7,14 +7,15 @@ import re
 from collections import namedtuple
 from datetime import date
 
-from peewee import JOIN, Window, fn, prefetch
+from peewee import EXCLUDED, JOIN, Case, Value, Window, chunked, fn, prefetch
 
 from .data import (DISCIPLINE_MAP, NAME_RE, NUMBER_RE, SCHEDULE_2018,
                    SCHEDULE_2019, SCHEDULE_2019_DATE, UPGRADES)
-from .models import (Event, ObraPersonSnapshot, PendingUpgrade, Person, Points,
-                     Race, Result, db)
-from .outputs import get_writer
-from .scrapers import scrape_person
+from .models import (Event, LatestResult, ObraPersonSnapshot, PendingUpgrade,
+                     Person, Points, PointsLeaderboard, Race, Result,
+                     UpgradeEvent, category_mask, db)
+from .outputs import get_writers
+from .scrapers import scrape_people, scrape_person
 
 logger = logging.getLogger(__name__)
 Point = namedtuple('Point', 'value,place,date')
@@ -34,7 +35,7 @@ def recalculate_points(upgrade_discipline, incremental=False):
                .where(Points.result_id << (Result.select(Result.id)
                                                  .join(Race, src=Result)
                                                  .join(Event, src=Race)
-                                                 .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])))
+                                                 .where(Event.upgrade_discipline == upgrade_discipline)))
                .execute())
 
     # Get all categorized races that don't have points yet
@@ -42,8 +43,8 @@ def recalculate_points(upgrade_discipline, incremental=False):
                  .join(Event, src=Race)
                  .join(Result, src=Race)
                  .join(Points, src=Result, join_type=JOIN.LEFT_OUTER)
-                 .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
-                 .where(Race.categories.length() > 0)
+                 .where(Event.upgrade_discipline == upgrade_discipline)
+                 .where(Race.category_mask > 0)
                  .group_by(Race, Event)
                  .having(fn.COUNT(Points.result_id) == 0))
 
@@ -61,11 +62,11 @@ def recalculate_points(upgrade_discipline, incremental=False):
                                            Person.id,
                                            Person.first_name,
                                            Person.last_name,
-                                           (Result.place.cast('integer') - 1).alias('zplace'))
+                                           (Result.place_num - 1).alias('zplace'))
                                    .join(Person, src=Result)
-                                   .where(Result.place.cast('integer') > 0)
-                                   .where(Result.place.cast('integer') <= len(points))
-                                   .order_by(Result.place.cast('integer').asc()))
+                                   .where(Result.place_num > 0)
+                                   .where(Result.place_num <= len(points))
+                                   .order_by(Result.place_num.asc()))
             for result in results.execute():
                 if not (NAME_RE.match(result.person.first_name) and NAME_RE.match(result.person.last_name)):
                     logger.debug('Invalid name: {} {}'.format(result.person.first_name, result.person.last_name))
@@ -120,7 +121,7 @@ def sum_points(upgrade_discipline):
                      .join(Person, src=Result)
                      .join(Race, src=Result)
                      .join(Event, src=Race)
-                     .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                     .where(Event.upgrade_discipline == upgrade_discipline)
                      .order_by(Person.id.asc(),
                                Race.date.asc(),
                                Race.created.asc()))
@@ -131,6 +132,9 @@ def sum_points(upgrade_discipline):
     categories = {9}
     upgrade_notes = []
     upgrade_race = Race(date=date(1970, 1, 1))
+    upgrade_event = None
+    standings = {}
+    upgrade_events = []
 
     for result in prefetch(results, Points):
         # Reset stats when the person changes
@@ -192,6 +196,7 @@ def sum_points(upgrade_discipline):
                     # If they're not a member or have been upgraded on the site, give them the upgrade.
                     # The actual upgrade probably happened much later, but we have no idea when so this is the best we can do.
                     upgrade_notes.append('UPGRADED TO {} WITH {} POINTS'.format(upgrade_category, points_sum()))
+                    upgrade_event = dict(kind='upgrade', from_category=max(categories), to_category=upgrade_category, premature=False)
                     cat_points[:] = []
                     categories = {upgrade_category}
                     upgrade_race = result.race
@@ -223,6 +228,8 @@ def sum_points(upgrade_discipline):
                     else:
                         upgrade_note = 'PREMATURELY '
                     upgrade_note += 'UPGRADED TO {} WITH {} POINTS'.format(max(result.race.categories), points_sum())
+                    upgrade_event = dict(kind='upgrade', from_category=max(categories), to_category=max(result.race.categories),
+                                         premature=upgrade_note.startswith('PREMATURELY'))
                     cat_points[:] = []
                     upgrade_notes.append(upgrade_note)
                     categories = {max(result.race.categories)}
@@ -241,6 +248,7 @@ def sum_points(upgrade_discipline):
                     # All their points expired and it's been a year since they changed categories, probably nobody cares, give them a downgrade
                     cat_points[:] = []
                     upgrade_notes.append('DOWNGRADED TO {}'.format(min(result.race.categories)))
+                    upgrade_event = dict(kind='downgrade', from_category=max(categories), to_category=min(result.race.categories), premature=False)
                     categories = {min(result.race.categories)}
                     upgrade_race = result.race
                 elif result.points:
@@ -269,6 +277,8 @@ def sum_points(upgrade_discipline):
                 result.points[0].needs_upgrade = True
 
             result.points[0].sum_categories = list(categories)
+            result.points[0].sum_category_mask = category_mask(categories)
+            result.points[0].sum_category_min = min(categories)
             result.points[0].sum_value = points_sum()
 
             if upgrade_race == result.race:
@@ -279,6 +289,16 @@ def sum_points(upgrade_discipline):
                 upgrade_notes[:] = []
 
             result.points[0].save()
+            standings[result.person.id] = (result.id, result.points[0], result.race.date)
+
+            if upgrade_event:
+                upgrade_events.append(dict(upgrade_event,
+                                           discipline=upgrade_discipline,
+                                           person=result.person.id,
+                                           result=result.id,
+                                           date=result.race.date,
+                                           upgrade_confirmation=result.points[0].upgrade_confirmation_id))
+                upgrade_event = None
 
         prev_result = result
 
@@ -297,26 +317,63 @@ def sum_points(upgrade_discipline):
             result.race.event.discipline,
             result.points[0].notes if result.points else ''))
 
+    update_leaderboard(upgrade_discipline, standings)
+    update_upgrade_events(upgrade_discipline, upgrade_events)
+    update_latest_results(upgrade_discipline)
 
-@db.savepoint()
-def confirm_pending_upgrades(upgrade_discipline):
+
+def update_leaderboard(upgrade_discipline, standings):
     """
-    Since upgrades are recognized the next race after they're earned,
-    we don't have a good way of suppressing them if someone is upgraded
-    on the OBRA website but don't race again.
-    Work around that by creating a PendingUpgrade record that will mark it until they race again.
+    Replace the points leaderboard for this discipline with everyone's current standing.
+    Standings map Person IDs to the Result ID, Points, and date of their most recent Points.
     """
-    logger.info('Checking for confirmed upgrades - upgrade_discipline={}'.format(upgrade_discipline))
-    (PendingUpgrade.delete()
-                   .where(PendingUpgrade.discipline == upgrade_discipline)
-                   .execute())
+    (PointsLeaderboard.delete()
+                      .where(PointsLeaderboard.discipline == upgrade_discipline)
+                      .execute())
+
+    # 9 is the placeholder category for people we haven't been able to categorize yet
+    rows = [(upgrade_discipline, category, person_id, result_id, points.sum_value, points.needs_upgrade, race_date)
+            for person_id, (result_id, points, race_date) in standings.items()
+            for category in points.sum_categories if category != 9]
+
+    for batch in chunked(rows, 500):
+        (PointsLeaderboard.insert_many(batch, fields=[PointsLeaderboard.discipline, PointsLeaderboard.category, PointsLeaderboard.person,
+                                                      PointsLeaderboard.result, PointsLeaderboard.sum_value, PointsLeaderboard.needs_upgrade,
+                                                      PointsLeaderboard.date])
+                          .execute())
+
+    logger.info('Updated points leaderboard with {} People'.format(len(standings)))
+
+
+def update_upgrade_events(upgrade_discipline, upgrade_events):
+    """
+    Replace the upgrades and downgrades for this discipline with the ones found while summing points.
+    """
+    (UpgradeEvent.delete()
+                 .where(UpgradeEvent.discipline == upgrade_discipline)
+                 .execute())
+
+    for batch in chunked(upgrade_events, 500):
+        UpgradeEvent.insert_many(batch).execute()
+
+    logger.info('Updated upgrade events with {} category changes'.format(len(upgrade_events)))
+
+
+def update_latest_results(upgrade_discipline):
+    """
+    Replace the latest results for this discipline with each person's most recent Result in a categorized Race,
+    along with their points as of that Result.
+    """
+    (LatestResult.delete()
+                 .where(LatestResult.discipline == upgrade_discipline)
+                 .execute())
 
     last_result = (Result.select()
                          .join(Race, src=Result)
                          .join(Event, src=Race)
-                         .join(Person, src=Result)
-                         .where(Race.categories.length() > 0)
-                         .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                         .where(Result.person_id.is_null(False))
+                         .where(Race.category_mask > 0)
+                         .where(Event.upgrade_discipline == upgrade_discipline)
                          .select(fn.DISTINCT(fn.FIRST_VALUE(Result.id)
                                                .over(partition_by=[Result.person_id],
                                                      order_by=[Race.date.desc(), Race.created.desc()],
@@ -324,42 +381,105 @@ def confirm_pending_upgrades(upgrade_discipline):
                                                      )
                                              ).alias('first_id')))
 
-    query = (Result.select(Result,
-                           Race,
-                           Event,
-                           Person,
-                           Points)
+    query = (Result.select(Value(upgrade_discipline),
+                           Result.person,
+                           Result.id,
+                           Race.date,
+                           Points.value,
+                           Points.needs_upgrade,
+                           Points.sum_value,
+                           Points.sum_categories,
+                           Points.sum_category_mask,
+                           Points.sum_category_min)
                    .join(Race, src=Result)
-                   .join(Event, src=Race)
-                   .join(Person, src=Result)
-                   .join(Points, src=Result)
-                   .where(Result.id << last_result)
-                   .where(Points.needs_upgrade == True)
-                   .where(~(Race.name.contains('Junior')))
-                   .order_by(Points.sum_categories.asc(),
-                             Points.sum_value.desc()))
-
-    for result in query.prefetch(Points):
-        result.points[0].sum_categories = [min(result.points[0].sum_categories) - 1]
-        confirm_category_change(result, ['UPGRADED'])
-        if result.points[0].upgrade_confirmation_id:
-            logger.debug('Confirmed pending upgrade for {}, {} to {}'.format(
-                result.person.last_name,
-                result.person.first_name,
-                result.points[0].sum_categories[0]))
-            (PendingUpgrade.insert(result_id=result.id,
-                                   upgrade_confirmation_id=result.points[0].upgrade_confirmation_id,
-                                   discipline=upgrade_discipline)
-                           .on_conflict(conflict_target=[PendingUpgrade.result],
-                                        preserve=[PendingUpgrade.upgrade_confirmation, PendingUpgrade.discipline])
-                           .execute())
-
-
-def print_points(upgrade_discipline, output_format):
+                   .join(Points, src=Result, join_type=JOIN.LEFT_OUTER)
+                   .where(Result.id << last_result))
+
+    count = (LatestResult.insert_from(query, fields=[LatestResult.discipline, LatestResult.person, LatestResult.result, LatestResult.date,
+                                                     LatestResult.value, LatestResult.needs_upgrade, LatestResult.sum_value,
+                                                     LatestResult.sum_categories, LatestResult.sum_category_mask,
+                                                     LatestResult.sum_category_min])
+                         .as_rowcount()
+                         .execute())
+
+    logger.info('Updated latest results with {} People'.format(count))
+
+
+@db.savepoint()
+def confirm_pending_upgrades(upgrade_discipline):
     """
-    Print out points tally for each Person
+    Since upgrades are recognized the next race after they're earned,
+    we don't have a good way of suppressing them if someone is upgraded
+    on the OBRA website but don't race again.
+    Work around that by creating a PendingUpgrade record that will mark it until they race again.
+    This is done as a handful of set-based queries; PendingUpgrade rows are only touched if they've changed.
     """
-    if output_format == 'null':
+    logger.info('Checking for confirmed upgrades - upgrade_discipline={}'.format(upgrade_discipline))
+
+    def needs_upgrade_query(*fields):
+        return (Result.select(*fields)
+                      .join(LatestResult, src=Result, on=(LatestResult.result == Result.id))
+                      .join(Race, src=Result)
+                      .join(Event, src=Race)
+                      .join(Points, src=Result)
+                      .where(LatestResult.discipline == upgrade_discipline)
+                      .where(LatestResult.needs_upgrade == True)
+                      .where(~(Race.name.contains('Junior'))))
+
+    # get_obra_data scrapes anyone we don't have any data for; do that all at once up front
+    missing = (Person.select()
+                     .where(Person.id << needs_upgrade_query(Result.person_id))
+                     .where(Person.id.not_in(ObraPersonSnapshot.select(ObraPersonSnapshot.person_id))))
+    missing = list(missing)
+    if missing:
+        scrape_people(missing)
+
+    # Same snapshot get_obra_data would pick - the newest on or before the race date, or failing that the oldest after it
+    Snapshot = ObraPersonSnapshot.alias()
+    snapshot_id = fn.COALESCE(Snapshot.select(Snapshot.id)
+                                      .where(Snapshot.person == Result.person)
+                                      .where(Snapshot.date <= Race.date)
+                                      .order_by(Snapshot.date.desc())
+                                      .limit(1),
+                              Snapshot.select(Snapshot.id)
+                                      .where(Snapshot.person == Result.person)
+                                      .order_by(Snapshot.date.asc())
+                                      .limit(1))
+
+    # The upgrade is confirmed if the site has them in the category above their current one.
+    # A previously confirmed category change on this result also counts.
+    obra_category = Case(Event.discipline, [(d, ObraPersonSnapshot.category_field(d)) for d in DISCIPLINE_MAP[upgrade_discipline]])
+    upgrade_category = Points.sum_category_min - 1
+    confirmation_id = Case(None, [((ObraPersonSnapshot.license != 0) & (obra_category <= upgrade_category), ObraPersonSnapshot.id)],
+                           Points.upgrade_confirmation_id)
+
+    confirmed = (needs_upgrade_query(Result.id, confirmation_id.alias('upgrade_confirmation_id'), Value(upgrade_discipline))
+                 .join(ObraPersonSnapshot, src=Result, on=(ObraPersonSnapshot.id == snapshot_id), join_type=JOIN.LEFT_OUTER)
+                 .where(confirmation_id.is_null(False)))
+
+    deleted = (PendingUpgrade.delete()
+                             .where(PendingUpgrade.discipline == upgrade_discipline)
+                             .where(PendingUpgrade.result_id.not_in(confirmed.select(Result.id)))
+                             .execute())
+
+    upserted = (PendingUpgrade.insert_from(confirmed, fields=[PendingUpgrade.result, PendingUpgrade.upgrade_confirmation, PendingUpgrade.discipline])
+                              .on_conflict(conflict_target=[PendingUpgrade.result],
+                                           preserve=[PendingUpgrade.upgrade_confirmation, PendingUpgrade.discipline],
+                                           where=((PendingUpgrade.upgrade_confirmation != EXCLUDED.upgrade_confirmation_id) |
+                                                  (PendingUpgrade.discipline != EXCLUDED.discipline)))
+                              .as_rowcount()
+                              .execute())
+
+    logger.info('Pending upgrades: {} removed, {} added or updated'.format(deleted, upserted))
+
+
+def print_points(upgrade_discipline, outputs):
+    """
+    Print out points tally for each Person.
+    Outputs is a list of (output_format, path) pairs; every output is written from the same pass over the data.
+    """
+    outputs = [(output_format, path) for output_format, path in outputs if output_format != 'null']
+    if not outputs:
         return
 
     cur_year = date.today().year
@@ -377,10 +497,11 @@ def print_points(upgrade_discipline, output_format):
                              .join(Race, src=Result)
                              .join(Event, src=Race)
                              .where(Race.date >= start_date)
-                             .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                             .where(Event.upgrade_discipline == upgrade_discipline)
                              .group_by(Person.id)
                              .having(Points.needs_upgrade == True)
-                             .order_by(Points.sum_categories.asc(),
+                             .order_by(Points.sum_category_min.asc(),
+                                       Points.sum_category_mask.desc(),
                                        Points.sum_value.desc(),
                                        Person.last_name.collate('NOCASE').asc(),
                                        Person.first_name.collate('NOCASE').asc()))
@@ -400,19 +521,21 @@ def print_points(upgrade_discipline, output_format):
                     .join(Person, src=Result)
                     .join(Race, src=Result)
                     .join(Event, src=Race)
-                    .where(Event.discipline << DISCIPLINE_MAP[upgrade_discipline])
+                    .where(Event.upgrade_discipline == upgrade_discipline)
                     .where(fn.LENGTH(Person.last_name) > 1)
                     .order_by(Person.last_name.collate('NOCASE').asc(),
                               Person.first_name.collate('NOCASE').asc(),
                               Race.date.asc()))
 
+    # Confirm that they haven't already been upgraded on the site
+    upgrades_needed = list(upgrades_needed.execute())
+    obra_data = get_obra_data_batch([(point.result.person, point.last_date) for point in upgrades_needed])
+
     person = None
-    with get_writer(output_format, upgrade_discipline) as writer:
+    with get_writers(upgrade_discipline, outputs) as writer:
         writer.start_upgrades()
-        for point in upgrades_needed.execute():
-            # Confirm that they haven't already been upgraded on the site
-            discipline = point.result.race.event.discipline
-            obra_category = get_obra_data(point.result.person, point.result.race.date).category_for_discipline(discipline)
+        for point in upgrades_needed:
+            obra_category = obra_data[point.result.person.id].category_for_discipline(point.result.race.event.discipline)
             if obra_category is not None and obra_category >= min(point.sum_categories):
                 writer.upgrade(point)
         writer.end_upgrades()
@@ -424,7 +547,8 @@ def print_points(upgrade_discipline, output_format):
                 person = point.result.person
                 writer.start_person(person)
             writer.point(point)
-        else:
+
+        if person:
             writer.end_person(person, True)
 
 
@@ -529,6 +653,38 @@ def get_obra_data(person, date):
     return data
 
 
+def get_obra_data_batch(person_dates):
+    """
+    Get snapshots of OBRA data for a list of (Person, date) pairs, using the same rules as get_obra_data.
+    Anyone we don't have any data for is scraped up front in one batch, then all the snapshots are loaded with
+    a single query. Returns a dict of Person ID to snapshot.
+    """
+    if not person_dates:
+        return {}
+
+    people = {person.id: person for person, _ in person_dates}
+    dates = {person.id: date for person, date in person_dates}
+    have_data = set(person_id for person_id, in (ObraPersonSnapshot.select(fn.DISTINCT(ObraPersonSnapshot.person_id))
+                                                                    .where(ObraPersonSnapshot.person_id << list(people))
+                                                                    .tuples()))
+    missing = [person for person_id, person in people.items() if person_id not in have_data]
+    if missing:
+        scrape_people(missing)
+
+    # Snapshots are in date order; keep the newest one on or before the requested date,
+    # or if there aren't any, the oldest one after it.
+    snapshots = {}
+    query = (ObraPersonSnapshot.select()
+                               .where(ObraPersonSnapshot.person_id << list(people))
+                               .order_by(ObraPersonSnapshot.date.asc()))
+    for data in query:
+        if data.person_id not in snapshots or data.date <= dates[data.person_id]:
+            snapshots[data.person_id] = data
+
+    logger.debug('OBRA Data: got {} snapshots for {} people ({} scraped)'.format(len(snapshots), len(people), len(missing)))
+    return snapshots
+
+
 def safe_int(value):
     try:
         return int(value)
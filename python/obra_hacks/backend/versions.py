@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+from peewee import EXCLUDED, JOIN, chunked
+
+from .models import (CategoryRank, DataVersion, Event, PendingUpgrade, Points,
+                     Quality, Race, Rank, Result)
+
+logger = logging.getLogger(__name__)
+# Tags touched by this process since the last pop_touched()
+touched = set()
+
+
+def tag(kind, key=None):
+    """
+    Build a data version tag, ie: tag('person', 123) -> 'person:123'
+    """
+    return kind if key is None else '{}:{}'.format(kind, key)
+
+
+def touch(tags):
+    """
+    Bump the version of each tag. This should be called inside the transaction that changes the data,
+    so that the new version becomes visible at the same time the new data does.
+    """
+    tags = sorted(set(tags))
+    if not tags:
+        return
+
+    logger.debug('Touching {} data version tags'.format(len(tags)))
+    touched.update(tags)
+    now = datetime.now()
+    for batch in chunked(tags, 300):
+        (DataVersion.insert_many([(t, 1, now) for t in batch], fields=[DataVersion.tag, DataVersion.version, DataVersion.updated])
+                    .on_conflict(conflict_target=[DataVersion.tag],
+                                 update={DataVersion.version: DataVersion.version + 1,
+                                         DataVersion.updated: EXCLUDED.updated})
+                    .execute())
+
+
+def pop_touched():
+    """
+    Get and forget the tags touched by this process since the last call,
+    so that cached copies of their versions can be expired once the changes are committed.
+    """
+    tags = set(touched)
+    touched.clear()
+    return tags
+
+
+def get_calculated(upgrade_discipline):
+    """
+    Get everything the points and rankings pipeline calculates for an upgrade discipline:
+    a dict of (result_id, person_id, event_id) to the Result's Points, Rank, and pending upgrade,
+    a dict of (race_id, event_id) to the Race's Quality, and a set of the CategoryRank rows.
+    """
+    results = (Result.select(Result.id, Result.person_id, Race.event_id,
+                             Points.value, Points.notes, Points.needs_upgrade, Points.upgrade_confirmation_id,
+                             Points.sum_value, Points.sum_categories, Rank.value, PendingUpgrade.upgrade_confirmation_id)
+                     .join(Race, src=Result)
+                     .join(Event, src=Race)
+                     .join(Points, src=Result, join_type=JOIN.LEFT_OUTER)
+                     .join(Rank, src=Result, join_type=JOIN.LEFT_OUTER)
+                     .join(PendingUpgrade, src=Result, join_type=JOIN.LEFT_OUTER)
+                     .where(Event.upgrade_discipline == upgrade_discipline)
+                     .tuples())
+    results = {row[:3]: row[3:] for row in results}
+
+    qualities = defaultdict(list)
+    query = (Quality.select(Race.id, Race.event_id, Quality.value, Quality.points_per_place)
+                    .join(Race, src=Quality)
+                    .join(Event, src=Race)
+                    .where(Event.upgrade_discipline == upgrade_discipline)
+                    .tuples())
+    for race_id, event_id, value, points_per_place in query:
+        qualities[(race_id, event_id)].append((value, points_per_place))
+    qualities = {race: sorted(values) for race, values in qualities.items()}
+
+    category_ranks = set(CategoryRank.select(CategoryRank.category, CategoryRank.person_id, CategoryRank.value, CategoryRank.place)
+                                     .where(CategoryRank.discipline == upgrade_discipline)
+                                     .tuples())
+    return (results, qualities, category_ranks)
+
+
+@contextmanager
+def track_changes(upgrade_discipline):
+    """
+    Touch the People and Events whose calculated Points, Ranks, race Quality, or pending upgrades are changed by the
+    points and rankings pipeline run inside this block. The discipline is touched too if anything changed, for the
+    leaderboards and upgrade lists that cover all of it.
+    Like touch(), this should be used inside the transaction that changes the data.
+    """
+    results, qualities, category_ranks = get_calculated(upgrade_discipline)
+    yield
+    new_results, new_qualities, new_category_ranks = get_calculated(upgrade_discipline)
+
+    tags = set()
+    for result_id, person_id, event_id in results.keys() | new_results.keys():
+        if results.get((result_id, person_id, event_id)) != new_results.get((result_id, person_id, event_id)):
+            tags.add(tag('event', event_id))
+            if person_id is not None:
+                tags.add(tag('person', person_id))
+
+    races = [(race_id, event_id) for race_id, event_id in qualities.keys() | new_qualities.keys()
+             if qualities.get((race_id, event_id)) != new_qualities.get((race_id, event_id))]
+    tags.update(tag('event', event_id) for race_id, event_id in races)
+    for batch in chunked([race_id for race_id, event_id in races], 500):
+        query = (Result.select(Result.person_id)
+                       .where(Result.race_id << batch)
+                       .where(Result.person_id.is_null(False))
+                       .distinct()
+                       .tuples())
+        tags.update(tag('person', person_id) for person_id, in query)
+
+    if tags or category_ranks != new_category_ranks:
+        tags.add(tag('discipline', upgrade_discipline))
+    logger.info('Points and rankings changed for {} People and Events in {}'.format(len(tags), upgrade_discipline))
+    touch(tags)
+
+
+def touch_event(event, person_ids=()):
+    """
+    Record a change to the Races or Results for an Event.
+    Points and upgrades for the people involved may have changed on any of their later results as well,
+    so Events they've raced since then are also touched.
+    """
+    tags = {tag('discipline', event.upgrade_discipline), tag('year', event.year), tag('event', event.id)}
+
+    if person_ids:
+        tags.add(tag('people'))
+        for batch in chunked(set(person_ids), 500):
+            tags.update(tag('person', person_id) for person_id in batch)
+            query = (Event.select(Event.id)
+                          .join(Race, src=Event)
+                          .join(Result, src=Race)
+                          .where(Event.upgrade_discipline == event.upgrade_discipline)
+                          .where(Event.year >= event.year)
+                          .where(Result.person_id << batch)
+                          .distinct()
+                          .tuples())
+            tags.update(tag('event', event_id) for event_id, in query)
+
+    touch(tags)
+
+
+def get_versions(tags):
+    """
+    Get the current (version, updated) for each tag. Tags that have never been touched are at version 0, and have never been updated.
+    """
+    versions = dict.fromkeys(tags, (0, None))
+    query = (DataVersion.select(DataVersion.tag, DataVersion.version, DataVersion.updated)
+                        .where(DataVersion.tag << list(versions))
+                        .tuples())
+    versions.update((t, (version, updated)) for t, version, updated in query)
+    return versions
@@ -22,7 +22,9 @@ setup(
     ],
     description='OBRA Hacks',
     entry_points={
-        'console_scripts': ['obra-upgrade-calculator=obra_hacks.backend.commands:cli']
+        'console_scripts': ['obra-upgrade-calculator=obra_hacks.backend.commands:cli',
+                            'obra-migrate=obra_hacks.backend.commands:migrate',
+                            'obra-vacuum=obra_hacks.backend.commands:vacuum']
     },
     include_package_data=True,
     install_requires=requirements,